@@ -0,0 +1,185 @@
+import asyncio
+import json
+
+from aiohttp import web, WSMsgType
+from graphql import build_schema, graphql
+
+from benchmark.synthetic_study import get_node_id
+from lib.halolink_connection import HLField, HLStudy, HLStudyEscrow
+
+# Just enough of the HALOLink schema for the queries and mutations in HalolinkConnection.
+SCHEMA = build_schema("""
+    enum FieldValueOperation { SET }
+
+    input ImageFieldValueUpdateInput {
+        operation: FieldValueOperation!
+        systemFieldId: ID!
+        newValue: String
+    }
+
+    input ChangeImagePropertiesInput { imageId: ID!, stain: String }
+    input UpdateImageFieldValuesInput { imageId: ID!, updates: [ImageFieldValueUpdateInput!]! }
+    input MoveImageToStudyInput { imageId: ID!, studyId: ID!, sourceStudyId: ID! }
+
+    type SystemField { pk: Int, id: ID, name: String, type: String }
+    type FieldValue { pk: Int, id: ID, value: String, type: String, string: String, text: String, systemField: SystemField }
+    type Image {
+        pk: Int, id: ID, location: String, tag: String, barcode: String, stain: String, permission: String,
+        resolvedRole: String, modifiedTime: String, createdTime: String, fieldValues: [FieldValue]
+    }
+    type StudyImage { image: Image }
+    type Study {
+        pk: Int, id: ID, name: String, isSystem: Boolean, isPublic: Boolean, description: String,
+        createdTime: String, permission: String, resolvedRole: String, studyImages: [StudyImage]
+    }
+    type StudyImageNode { study: Study }
+
+    type ImageMutated { node: Image }
+    type FieldValueMutated { node: FieldValue }
+    type StudyImageMutated { node: StudyImageNode }
+    type ImagePayload { mutated: [ImageMutated] }
+    type FieldValuePayload { mutated: [FieldValueMutated] }
+    type StudyImagePayload { mutated: [StudyImageMutated] }
+
+    type Query {
+        imageByPk(pk: Int!): Image
+        studyByPk(pk: Int!): Study
+    }
+
+    type Mutation {
+        changeImageProperties(input: ChangeImagePropertiesInput!): ImagePayload
+        updateImageFieldValues(input: UpdateImageFieldValuesInput!): FieldValuePayload
+        moveImageToStudy(input: MoveImageToStudyInput!): StudyImagePayload
+    }
+""")
+
+SYSTEM_FIELDS = {field.value["id"]: {"pk": i + 1, "id": field.value["id"], "name": field.value["name"], "type": "Text"}
+                 for i, field in enumerate(HLField)}
+
+
+class FakeStudy:
+
+    def __init__(self, server, study: dict):
+        self.server = server
+        self.pk = study["pk"]
+        self.id = study["id"]
+        self.name = study["name"]
+        self.isSystem = False
+        self.isPublic = False
+        self.description = ""
+        self.createdTime = "2024-01-01T00:00:00Z"
+        self.permission = "Write"
+        self.resolvedRole = "Owner"
+        self.image_pks = []
+
+    @property
+    def studyImages(self):
+        return [{"image": self.server.images[image_pk]} for image_pk in self.image_pks]
+
+
+class FakeHalolinkServer:
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.images = {}
+        self.image_ids = {}
+        self.studies = {}
+        self.study_ids = {}
+        self.request_count = 0
+        for study in list(HLStudy) + list(HLStudyEscrow):
+            if study.value["pk"] not in self.studies:
+                fake_study = FakeStudy(self, study.value)
+                self.studies[fake_study.pk] = fake_study
+                self.study_ids[fake_study.id] = fake_study
+
+    def add_images(self, study_pk: int, images: list):
+        for image in images:
+            image = dict(image, permission="Write", resolvedRole="Owner", modifiedTime="2024-01-01T00:00:00Z",
+                         createdTime="2024-01-01T00:00:00Z", fieldValues=list(image["fieldValues"]))
+            self.images[image["pk"]] = image
+            self.image_ids[image["id"]] = image
+            self.studies[study_pk].image_pks.append(image["pk"])
+
+    async def imageByPk(self, info, pk: int):
+        return self.images.get(pk)
+
+    async def studyByPk(self, info, pk: int):
+        return self.studies.get(pk)
+
+    async def changeImageProperties(self, info, input: dict):
+        image = self.image_ids[input["imageId"]]
+        image["stain"] = input.get("stain")
+        return {"mutated": [{"node": image}]}
+
+    async def updateImageFieldValues(self, info, input: dict):
+        image = self.image_ids[input["imageId"]]
+        field_values = {field_value["systemField"]["id"]: field_value for field_value in image["fieldValues"]}
+        for update in input["updates"]:
+            system_field = SYSTEM_FIELDS[update["systemFieldId"]]
+            field_values[system_field["id"]] = {"pk": system_field["pk"], "id": get_node_id("FieldValue", image["pk"]),
+                                                "value": update["newValue"], "type": "Text",
+                                                "string": update["newValue"], "text": update["newValue"],
+                                                "systemField": system_field}
+        image["fieldValues"] = list(field_values.values())
+        return {"mutated": [{"node": field_value} for field_value in image["fieldValues"]]}
+
+    async def moveImageToStudy(self, info, input: dict):
+        image = self.image_ids[input["imageId"]]
+        src_study = self.study_ids[input["sourceStudyId"]]
+        dest_study = self.study_ids[input["studyId"]]
+        if image["pk"] not in src_study.image_pks:
+            raise ValueError("Image is not in the source study.")
+        src_study.image_pks.remove(image["pk"])
+        if src_study is not dest_study:
+            dest_study.image_pks.append(image["pk"])
+        return {"mutated": [{"node": {"study": dest_study}}]}
+
+    async def execute(self, payload: dict) -> dict:
+        self.request_count = self.request_count + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = await graphql(SCHEMA, payload["query"], root_value=self,
+                               variable_values=payload.get("variables"), operation_name=payload.get("operationName"))
+        response = {"data": result.data}
+        if result.errors:
+            response["errors"] = [error.formatted for error in result.errors]
+        return response
+
+    async def handle_token(self, request: web.Request) -> web.Response:
+        return web.json_response({"access_token": "benchmark", "expires_in": 3600, "token_type": "Bearer"})
+
+    # Apollo graphql-ws protocol, which is what WebsocketsTransport speaks.
+    async def handle_graphql(self, request: web.Request) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse(protocols=["graphql-ws"], max_msg_size=0)
+        await websocket.prepare(request)
+        operations = set()
+
+        async def run_operation(operation_id: str, payload: dict):
+            try:
+                response = await self.execute(payload)
+                await websocket.send_str(json.dumps({"type": "data", "id": operation_id, "payload": response}))
+                await websocket.send_str(json.dumps({"type": "complete", "id": operation_id}))
+            except ConnectionResetError:
+                pass
+
+        async for message in websocket:
+            if message.type != WSMsgType.TEXT:
+                continue
+            message = json.loads(message.data)
+            if message["type"] == "connection_init":
+                await websocket.send_str(json.dumps({"type": "connection_ack"}))
+            elif message["type"] == "start":
+                task = asyncio.create_task(run_operation(message["id"], message["payload"]))
+                operations.add(task)
+                task.add_done_callback(operations.discard)
+            elif message["type"] == "connection_terminate":
+                break
+        for task in list(operations):
+            task.cancel()
+        return websocket
+
+    def get_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/idsrv/connect/token", self.handle_token)
+        app.router.add_get("/graphql", self.handle_graphql)
+        return app
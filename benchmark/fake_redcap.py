@@ -0,0 +1,35 @@
+import asyncio
+import re
+
+from aiohttp import web
+
+BIOPSY_ID_FILTER = re.compile(r"\[biopsyid\]='([^']*)'")
+
+
+class FakeRedcapServer:
+
+    def __init__(self, records: dict, latency: float = 0.0):
+        self.records = records
+        self.latency = latency
+        self.request_count = 0
+
+    # Only the record export with a biopsy ID filterLogic is supported, which is all RedcapConnection sends.
+    async def handle_api(self, request: web.Request) -> web.Response:
+        self.request_count = self.request_count + 1
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if data.get("content") != "record" or data.get("action") != "export":
+            return web.json_response({"error": "Only record exports are supported."}, status=400)
+        fields = [value for key, value in data.items() if key.startswith("fields[")]
+        records = []
+        for biopsy_id in BIOPSY_ID_FILTER.findall(data.get("filterLogic", "")):
+            if biopsy_id in self.records:
+                record = self.records[biopsy_id]
+                records.append({field: record.get(field, "") for field in fields} if fields else dict(record))
+        return web.json_response(records)
+
+    def get_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/", self.handle_api)
+        return app
@@ -0,0 +1,42 @@
+# In-memory stand-in for the Uploader Mongo database, covering the packages queries UploaderConnection makes.
+class FakePackagesCollection:
+
+    def __init__(self, packages: list):
+        self.packages = packages
+        self.indexes = {"_id_": {"key": [("_id", 1)]}}
+        self.packages_by_file_name = {}
+        for package in packages:
+            for file in package["files"]:
+                self.packages_by_file_name.setdefault(file["fileName"], package)
+
+    @staticmethod
+    def project(package: dict, projection: dict) -> dict:
+        return {key: package[key] for key, include in projection.items() if include and key in package}
+
+    def find_one(self, query: dict, projection: dict = None):
+        file_name = query["files"]["$elemMatch"]["$and"][0]["fileName"]
+        package = self.packages_by_file_name.get(file_name)
+        if package is None:
+            return None
+        return self.project(package, projection) if projection else dict(package)
+
+    def aggregate(self, pipeline: list):
+        file_names = pipeline[0]["$match"]["files.fileName"]["$in"]
+        for file_name in file_names:
+            package = self.packages_by_file_name.get(file_name)
+            if package is not None:
+                yield dict(self.project(package, {"study": 1, "packageType": 1}), fileName=file_name)
+
+    def index_information(self) -> dict:
+        return self.indexes
+
+    def create_index(self, key: str) -> str:
+        name = key.replace(".", "_") + "_1"
+        self.indexes[name] = {"key": [(key, 1)]}
+        return name
+
+
+class FakeUploaderDatabase:
+
+    def __init__(self, packages: list):
+        self.packages = FakePackagesCollection(packages)
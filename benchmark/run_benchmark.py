@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import tempfile
+import time
+
+from aiohttp import web
+
+from benchmark.fake_halolink import FakeHalolinkServer
+from benchmark.fake_redcap import FakeRedcapServer
+from benchmark.fake_uploader import FakeUploaderDatabase
+from benchmark.synthetic_study import generate_study
+from lib.halolink_connection import HalolinkConnection, HLStudy, DEFAULT_PAGE_SIZE
+from lib.redcap_connection import RedcapConnection
+from lib.uploader_connection import UploaderConnection
+from services.pipeline_service import PipelineService, DEFAULT_CONCURRENCY, DEFAULT_BATCH_SIZE
+
+SOURCE_FOLDERS = {
+    "CI": HLStudy.INCOMING_CUREGN,
+    "CE1": HLStudy.CUREGN_ESCROW_1,
+    "CDI": HLStudy.INCOMING_CUREGN_DIABETES,
+    "CDE1": HLStudy.CUREGN_DIABETES_ESCROW_1,
+    "NI": HLStudy.INCOMING_NEPTUNE,
+    "NE1": HLStudy.NEPTUNE_ESCROW_1,
+}
+
+
+class StageTimer:
+
+    def __init__(self):
+        self.durations = {}
+
+    def record(self, stage: str, start: float):
+        self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def wrap(self, target, method_name: str, stage: str = None):
+        method = getattr(target, method_name)
+        stage = stage or method_name
+
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                self.record(stage, start)
+
+        setattr(target, method_name, timed)
+
+    def wrap_sync(self, target, method_name: str, stage: str = None):
+        method = getattr(target, method_name)
+        stage = stage or method_name
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(stage, start)
+
+        setattr(target, method_name, timed)
+
+    # HALOLink requests are timed per operation, e.g. "halolink query imageByPk".
+    def wrap_halolink(self, halolink_connection: HalolinkConnection):
+        execute = halolink_connection.execute
+
+        async def timed(document, *args, **kwargs):
+            definition = document.definitions[0]
+            stage = "halolink " + definition.operation.value + " " + definition.selection_set.selections[0].name.value
+            start = time.perf_counter()
+            try:
+                return await execute(document, *args, **kwargs)
+            finally:
+                self.record(stage, start)
+
+        halolink_connection.execute = timed
+
+    def print_report(self):
+        print("Stage,Calls,Total s,Mean ms,p50 ms,p95 ms")
+        for stage, durations in sorted(self.durations.items()):
+            durations = sorted(durations)
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            print(f"{stage},{len(durations)},{sum(durations):.3f},{statistics.mean(durations) * 1000:.2f},"
+                  f"{statistics.median(durations) * 1000:.2f},{p95 * 1000:.2f}")
+
+
+async def start_server(app: web.Application) -> tuple:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+async def run_benchmark(args, src_study: HLStudy, dry_run: bool):
+    study = generate_study(src_study, args.images, args.biopsies, args.missing_fraction)
+    halolink_server = FakeHalolinkServer(args.latency)
+    halolink_server.add_images(src_study.value["pk"], study["images"])
+    redcap_server = FakeRedcapServer(study["redcap_records"], args.latency)
+    halolink_runner, halolink_port = await start_server(halolink_server.get_app())
+    redcap_runner, redcap_port = await start_server(redcap_server.get_app())
+
+    halolink_connection = HalolinkConnection()
+    halolink_connection.client_id = "benchmark"
+    halolink_connection.token_cache_path = os.path.join(tempfile.gettempdir(), "benchmark_halolink_token.json")
+    halolink_connection.token_url = f"http://127.0.0.1:{halolink_port}/idsrv/connect/token"
+    halolink_connection.graphql_url = f"ws://127.0.0.1:{halolink_port}/graphql"
+    redcap_connection = RedcapConnection(project=src_study.value["redcap_project"])
+    redcap_connection.url = f"http://127.0.0.1:{redcap_port}/api/"
+    uploader_connection = UploaderConnection()
+    uploader_connection.mongo_session = FakeUploaderDatabase(study["packages"])
+    pipeline_service = PipelineService(halolink_connection, redcap_connection, uploader_connection,
+                                       args.workers, args.batch_size, args.page_size)
+    pipeline_service.output = io.StringIO()
+
+    timer = StageTimer()
+    timer.wrap_halolink(halolink_connection)
+    timer.wrap(redcap_connection, "get_filtered_records_async", "redcap export")
+    timer.wrap_sync(uploader_connection, "get_records_by_file_names", "uploader lookup")
+    timer.wrap(pipeline_service, "prefetch_redcap_data", "pipeline prefetch_redcap_data")
+    timer.wrap(pipeline_service, "prefetch_uploader_data", "pipeline prefetch_uploader_data")
+    # Includes time spent waiting for a worker.
+    timer.wrap(pipeline_service, "process_batch", "pipeline process_batch")
+
+    try:
+        await halolink_connection.connect()
+        start = time.perf_counter()
+        await pipeline_service.get_metadata_for_images_in_study(src_study, src_study.value["default_study"], dry_run)
+        elapsed = time.perf_counter() - start
+    finally:
+        await halolink_connection.close()
+        await redcap_connection.close()
+        await halolink_runner.cleanup()
+        await redcap_runner.cleanup()
+
+    summary = pipeline_service.run_summary
+    print(f"Mode: {'dry run' if dry_run else 'attach'}, {src_study.value['name']}, {args.images} images, "
+          f"{args.biopsies} biopsies, workers {args.workers}, batch size {args.batch_size}, page size {args.page_size}, "
+          f"latency {args.latency * 1000:.0f} ms")
+    print(f"Elapsed: {elapsed:.2f} s, {summary['processed'] / elapsed:.1f} images/sec")
+    print(f"Requests: HALOLink {halolink_server.request_count}, REDCap {redcap_server.request_count}")
+    print("Summary: " + ", ".join(f"{key} {value}" for key, value in summary.items()))
+    # Stages overlap when workers > 1, so their totals can add up to more than the elapsed time.
+    timer.print_report()
+    print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='MiKTMC Image Pipeline Benchmark',
+        description='Measures pipeline throughput against local stand-ins for HALOLink, REDCap and the Uploader database.',
+    )
+    parser.add_argument("--images", type=int, default=10000, help='Number of images in the synthetic study.')
+    parser.add_argument("--biopsies", type=int, default=2000, help='Number of biopsies the images are spread across.')
+    parser.add_argument("--missing_fraction", type=float, default=0.02,
+                        help='Fraction of biopsies without a REDCap record.')
+    parser.add_argument("--mode", choices=["dry_run", "attach", "both"], default="both",
+                        help='Pipeline mode to benchmark.')
+    parser.add_argument("--study", choices=list(SOURCE_FOLDERS.keys()), default="CI",
+                        help='Source folder the synthetic images are placed in.')
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help='Seconds of simulated latency added to every HALOLink and REDCap request.')
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--page_size", type=int, default=DEFAULT_PAGE_SIZE)
+    args = parser.parse_args()
+    modes = [True, False] if args.mode == "both" else [args.mode == "dry_run"]
+    for dry_run in modes:
+        asyncio.run(run_benchmark(args, SOURCE_FOLDERS[args.study], dry_run))
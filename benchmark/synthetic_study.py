@@ -0,0 +1,53 @@
+import base64
+import random
+
+from lib.halolink_connection import HLStudy
+from lib.redcap_connection import DEFAULT_FIELD_LIST
+
+MAX_SLIDES = 20
+
+
+def get_node_id(type_name: str, primary_key: int) -> str:
+    return base64.b64encode(f"{type_name}:{primary_key}".encode()).decode()
+
+
+# Builds the HALOLink images, REDCap records and Uploader packages for a synthetic source study. About a
+# third of each biopsy's images are EMs, and missing_fraction of the biopsies have no REDCap record.
+def generate_study(src_study: HLStudy, num_images: int, num_biopsies: int, missing_fraction: float = 0.02,
+                   seed: int = 1) -> dict:
+    generator = random.Random(seed)
+    biopsy_ids = [f"{src_study.name[:3]}{i:05d}_{generator.randint(1, 9)}" for i in range(num_biopsies)]
+    images = []
+    redcap_records = {}
+    packages = []
+    image_counts = [num_images // num_biopsies + (1 if i < num_images % num_biopsies else 0) for i in range(num_biopsies)]
+    for biopsy_id, image_count in zip(biopsy_ids, image_counts):
+        wsi_count = min(MAX_SLIDES, max(1, (image_count * 2) // 3)) if image_count else 0
+        record = {field: "" for field in DEFAULT_FIELD_LIST}
+        record.update({
+            "biopsyid": biopsy_id,
+            "subjectid": "S" + biopsy_id.split("_")[0],
+            "pathdiseasecohort": str(generator.randint(1, 6)),
+            "renalbxdate": f"20{generator.randint(10, 23)}-0{generator.randint(1, 9)}-1{generator.randint(0, 9)}",
+            "numems_qc": str(image_count - wsi_count),
+            "numbarcodes": str(wsi_count),
+        })
+        for slide in range(image_count):
+            pk = len(images) + 1
+            if slide < wsi_count:
+                barcode = f"{biopsy_id}-{slide + 1:02d}"
+                tag = f"{biopsy_id}_{slide + 1:02d}.svs"
+                record[f"slidebarcode{slide + 1}"] = barcode
+                record[f"slidelevel{slide + 1}"] = str(generator.randint(1, 3))
+                record[f"slidestain{slide + 1}"] = str(generator.randint(1, 9))
+                package_type = "Whole Slide Image"
+            else:
+                barcode = ""
+                tag = f"{biopsy_id}_EM{slide + 1:02d}.jpg"
+                package_type = "Electron Microscopy Imaging"
+            images.append({"pk": pk, "id": get_node_id("Image", pk), "location": f"/synthetic/{tag}", "tag": tag,
+                           "barcode": barcode, "stain": "", "fieldValues": []})
+            packages.append({"study": "CureGN", "packageType": package_type, "files": [{"fileName": tag}]})
+        if generator.random() >= missing_fraction:
+            redcap_records[biopsy_id] = record
+    return {"images": images, "redcap_records": redcap_records, "packages": packages}
@@ -1,274 +1,374 @@
+import asyncio
+import json
+import logging
 import ssl
 import os
+import time
 import aiohttp
 from gql import Client
-from gql import gql
+from gql.transport.exceptions import TransportClosed, TransportQueryError, TransportServerError
 from gql.transport.websockets import WebsocketsTransport
-from enum import Enum
+
+from lib.halolink_documents import IMAGE_BY_PK, STUDY_IMAGES, STUDY_IMAGE_PKS, STUDY_IMAGE_TAGS, STUDY_INFO, \
+    UPDATE_STAIN, MOVE_IMAGE, \
+    get_field_value_variables, get_set_image_fields_document, get_images_by_pks_document, get_batch_update_document
+from lib.halolink_enums import HLField, HLStudyEscrow, HLStudy
+from lib.pipeline_metrics import PipelineMetrics
+from lib.request_governor import RequestGovernor
+
+logger = logging.getLogger("lib-HalolinkConnection")
 
 HALOLINK_HOST = "dpr.niddk.nih.gov"
+DEFAULT_EXECUTE_TIMEOUT = 40
+DEFAULT_TOKEN_CACHE_PATH = ".halolink_token.json"
+# Used when the token response doesn't say how long the token lasts.
+DEFAULT_TOKEN_LIFETIME = 3600
+# Seconds before expiry that a token is replaced.
+TOKEN_REFRESH_MARGIN = 300
+RECONNECT_ERRORS = (TransportClosed, ConnectionError)
+# Errors the request governor may retry after a backoff.
+RETRY_ERRORS = (asyncio.TimeoutError, TransportServerError, TransportQueryError)
+# Number of images fetched per request when paging through a study.
+DEFAULT_PAGE_SIZE = 200
+# Websockets opened to HALOLink. Requests go to the least busy socket of the pool. Read sessions are extra sockets
+# only used for queries, so a large study listing or page of images doesn't hold up mutations queued behind it.
+DEFAULT_POOL_SIZE = 1
+DEFAULT_READ_SESSIONS = 0
+
+
+# Names a request in the metrics by its operation type and top level field, e.g. "query imageByPk". Aliased
+# documents that mix fields, like batched updates, are named "mutation batch". Also returns how many times each
+# field appears, which is the number of images or mutations the request carries.
+def get_operation_name(document) -> tuple:
+    definition = document.definitions[0]
+    field_counts = {}
+    for selection in definition.selection_set.selections:
+        field_counts[selection.name.value] = field_counts.get(selection.name.value, 0) + 1
+    name = next(iter(field_counts)) if len(field_counts) == 1 else "batch"
+    return definition.operation.value + " " + name, field_counts
 
 
-class HLField(Enum):
-    STUDY_ID = {"id": "U3lzdGVtRmllbGQ6Mw==", "name": "StudyID"}
-    ORGAN = {"id": "U3lzdGVtRmllbGQ6MjE=", "name": "Organ"}
-    IMAGE_TYPE = {"id": "U3lzdGVtRmllbGQ6MTU=", "name": "Image_Type"}
-    BIOPSY_DATE = {"id": "U3lzdGVtRmllbGQ6Ng==", "name": "Biopsy_Date"}
-    NPT_PATIENT_STUDY_ID = {"id": "U3lzdGVtRmllbGQ6OQ==", "name": "NPT_PatientStudyID"}
-    CGN_PATIENT_STUDY_ID = {"id": "U3lzdGVtRmllbGQ6MTA=", "name": "CGN_PatientStudyID"}
-    DISEASE = {"id": "U3lzdGVtRmllbGQ6MTE=", "name": "Disease"}
-    BIOPSY_ID = {"id": "U3lzdGVtRmllbGQ6MTI=", "name": "BiopsyID"}
-    TISSUE_COMMENT = {"id": "U3lzdGVtRmllbGQ6MjI=", "name": "Tissue_Comment"}
-    EVENT_TYPE = {"id": "U3lzdGVtRmllbGQ6MTY=", "name": "Event_Type"}
-    LEVEL = {"id": "U3lzdGVtRmllbGQ6MTQ=", "name": "Level"}
-
-# Destination studies
-class HLStudyEscrow(Enum):
-    CUREGN_ESCROW_1 = {"pk": 9735, "id": "U3R1ZHk6OTczNQ==", "name": "CureGN Escrow 1"}
-    CUREGN_ESCROW_2 = {"pk": 9703, "id": "U3R1ZHk6OTcwMw==", "name": "CureGN Escrow 2"}
-    CUREGN_DIABETES_ESCROW_1 = {"pk": 9837, "id": "U3R1ZHk6OTgzNw==", "name": "CureGN Diabetes Escrow 1"}
-    CUREGN_DIABETES_ESCROW_2 = {"pk": 9838, "id": "U3R1ZHk6OTgzOA==", "name": "CureGN Diabetes Escrow 2"}
-    NEPTUNE_ESCROW_1 = {"pk": 9666, "id": "U3R1ZHk6OTY2Ng==", "name": "Neptune Escrow 1"}
-    NEPTUNE_ESCROW_2 = {"pk": 9696, "id": "U3R1ZHk6OTY5Ng==", "name": "Neptune Escrow 2"}
-
-# Source studies
-class HLStudy(Enum):
-    INCOMING_CUREGN = {"pk": 9783, "id": "U3R1ZHk6OTc4Mw==", "name": "Incoming CureGN", "escrow": False, "success_dest": HLStudyEscrow.CUREGN_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_ESCROW_1}
-    CUREGN_ESCROW_1 = {"pk": 9735, "id": "U3R1ZHk6OTczNQ==", "name": "CureGN Escrow 1",  "escrow": True, "success_dest": HLStudyEscrow.CUREGN_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_ESCROW_1}
-    INCOMING_CUREGN_DIABETES = {"pk": 10487, "id": "U3R1ZHk6MTA0ODc=", "name": "Incoming CureGN Diabetes",  "escrow": False, "success_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_1}
-    CUREGN_DIABETES_ESCROW_1 = {"pk": 9837, "id": "U3R1ZHk6OTgzNw==", "name": "CureGN Diabetes Escrow 1",  "escrow": True, "success_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_1}
-    INCOMING_NEPTUNE = {"pk": 9784, "id": "U3R1ZHk6OTc4NA==", "name": "Incoming Neptune",  "escrow": False, "success_dest": HLStudyEscrow.NEPTUNE_ESCROW_2, "failure_dest": HLStudyEscrow.NEPTUNE_ESCROW_1}
-    NEPTUNE_ESCROW_1 = {"pk": 9666, "id": "U3R1ZHk6OTY2Ng==", "name": "Neptune Escrow 1",  "escrow": True, "success_dest": HLStudyEscrow.NEPTUNE_ESCROW_2, "failure_dest": HLStudyEscrow.NEPTUNE_ESCROW_1}
+# One authenticated websocket to HALOLink, the governor its requests go through and the number of requests running
+# on it.
+class HalolinkSession:
+
+    def __init__(self, name: str, governor: RequestGovernor):
+        self.name = name
+        self.governor = governor
+        self.client = None
+        self.client_session = None
+        self.generation = 0
+        self.token_expires_at = 0
+        self.in_flight = 0
+        self.reconnect_lock = asyncio.Lock()
+
 
 class HalolinkConnection:
 
     def __init__(self):
         self.access_token = ""
+        self.token_expires_at = 0
         self.client_id = os.environ.get("halolink_client_id")
         self.client_secret = os.environ.get("halolink_client_secret")
-        self.client_session = None
+        self.token_cache_path = os.environ.get("halolink_token_cache_path") or DEFAULT_TOKEN_CACHE_PATH
+        self.token_url = os.environ.get("halolink_token_url") or f"https://{HALOLINK_HOST}/idsrv/connect/token"
+        self.graphql_url = os.environ.get("halolink_graphql_url") or f"wss://{HALOLINK_HOST}/graphql"
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS)
+        self.add_local_bearer = False
+        self.pool_size = max(1, int(os.environ.get("halolink_pool_size") or DEFAULT_POOL_SIZE))
+        self.read_sessions = int(os.environ.get("halolink_read_sessions") or DEFAULT_READ_SESSIONS)
+        self.governor = RequestGovernor()
+        # Read sessions have their own slots and concurrency limit, so a slow listing doesn't shrink the limit
+        # mutations are sent under.
+        self.read_governor = RequestGovernor() if self.read_sessions else self.governor
+        self.sessions = [HalolinkSession("pool-" + str(i), self.governor) for i in range(self.pool_size)]
+        self.read_pool = [HalolinkSession("read-" + str(i), self.read_governor) for i in range(self.read_sessions)]
+        self.token_lock = asyncio.Lock()
+        self.execute_timeout = int(os.environ.get("halolink_execute_timeout") or DEFAULT_EXECUTE_TIMEOUT)
+        self.metrics = PipelineMetrics()
+
+    async def connect(self, add_local_bearer=False):
+        await self.ensure_access_token()
+        await self.create_client_session(add_local_bearer)
 
     async def request_access_token(self):
+        self.metrics.increment("halolink_token_requests_total")
         async with aiohttp.ClientSession() as session:
             async with session.request(
                     method="post",
-                    url=f"https://{HALOLINK_HOST}/idsrv/connect/token",
+                    url=self.token_url,
                     data={
                         "client_id": self.client_id,
                         "client_secret": self.client_secret,
                         "scope": "serviceuser graphql",
                         "grant_type": "client_credentials"
                     },
-                    ssl=ssl.SSLContext(ssl.PROTOCOL_TLS),
+                    ssl=self.ssl_context if self.token_url.startswith("https://") else None,
                     raise_for_status=True
             ) as response:
                 data = await response.json()
                 self.access_token = data['access_token']
+                self.token_expires_at = time.time() + int(data.get('expires_in', DEFAULT_TOKEN_LIFETIME))
+        self.save_access_token()
+
+    # Tokens are shared between CLI invocations through a small file only readable by the current user.
+    def load_access_token(self) -> bool:
+        try:
+            with open(self.token_cache_path) as token_file:
+                cached_token = json.load(token_file)
+        except (OSError, ValueError):
+            return False
+        if cached_token.get("client_id") != self.client_id:
+            return False
+        self.access_token = cached_token["access_token"]
+        self.token_expires_at = cached_token["expires_at"]
+        return True
+
+    def save_access_token(self):
+        try:
+            file_descriptor = os.open(self.token_cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(file_descriptor, "w") as token_file:
+                json.dump({"client_id": self.client_id, "access_token": self.access_token,
+                           "expires_at": self.token_expires_at}, token_file)
+        except OSError as error:
+            logger.warning("Unable to cache HALOLink access token: %s", error)
+
+    def token_needs_refresh(self) -> bool:
+        return self.token_expires_at - time.time() < TOKEN_REFRESH_MARGIN
 
+    # Locked so sessions reconnecting at the same time share one new token.
+    async def ensure_access_token(self):
+        async with self.token_lock:
+            if self.token_needs_refresh() and not (self.load_access_token() and not self.token_needs_refresh()):
+                await self.request_access_token()
+
+    # Opens every session of the pool at the same time.
     async def create_client_session(self, add_local_bearer=False):
+        self.add_local_bearer = add_local_bearer
+        await asyncio.gather(*[self.open_session(session) for session in self.sessions + self.read_pool])
+
+    async def open_session(self, session: HalolinkSession):
         transport = WebsocketsTransport(
-            url=f"wss://{HALOLINK_HOST}/graphql",
+            url=self.graphql_url,
             headers={"authorization": f"bearer {self.access_token}"},
             subprotocols=[WebsocketsTransport.APOLLO_SUBPROTOCOL],
-            ssl=ssl.SSLContext(ssl.PROTOCOL_TLS),
+            ssl=self.ssl_context if self.graphql_url.startswith("wss://") else None,
             connect_timeout=40,
             connect_args={"max_size": None}
         )
-        if add_local_bearer:
+        if self.add_local_bearer:
             transport.headers["x-authentication-scheme"] = "LocalBearer"
 
-        client = Client(transport=transport, execute_timeout=40)
-        self.client_session = await client.connect_async()
+        client = Client(transport=transport, execute_timeout=self.execute_timeout)
+        session.client_session = await client.connect_async()
+        old_client = session.client
+        session.client = client
+        session.token_expires_at = self.token_expires_at
+        session.generation = session.generation + 1
+        if old_client is not None:
+            # Give requests still running on the old socket time to finish before closing it.
+            asyncio.get_running_loop().call_later(self.execute_timeout, asyncio.ensure_future, self.close_client(old_client))
+
+    async def close_client(self, client: Client):
+        try:
+            await client.close_async()
+        except Exception as error:
+            logger.warning("Error closing HALOLink session: %s", error)
+
+    async def close(self):
+        for session in self.sessions + self.read_pool:
+            if session.client is not None:
+                await self.close_client(session.client)
+                session.client = None
+                session.client_session = None
+
+    async def reconnect(self, session: HalolinkSession, generation: int):
+        async with session.reconnect_lock:
+            # Another request already reconnected while this one was waiting.
+            if generation != session.generation:
+                return
+            self.metrics.increment("halolink_reconnects_total", session=session.name)
+            await self.ensure_access_token()
+            await self.open_session(session)
+
+    # Queries go to the read sessions when there are any. Ties go to the first session, so a pool that is never
+    # busy keeps using one socket.
+    def get_session(self, operation: str) -> HalolinkSession:
+        sessions = self.sessions
+        if self.read_pool and operation.startswith("query "):
+            sessions = self.read_pool
+        return min(sessions, key=lambda session: session.in_flight)
+
+    # All requests go through here. Timeouts and throttling are retried with backoff by the request governor,
+    # as long as the request is safe to repeat or was rejected without running.
+    async def execute(self, document, variable_values: dict = None, idempotent: bool = True):
+        operation, field_counts = get_operation_name(document)
+        for field, count in field_counts.items():
+            self.metrics.increment("halolink_fields_total", count, field=field)
+        attempt = 0
+        while True:
+            try:
+                return await self.execute_once(document, variable_values, idempotent, operation)
+            except RETRY_ERRORS as error:
+                if attempt >= self.governor.max_retries or not self.governor.is_retryable(error, idempotent):
+                    raise
+                attempt = attempt + 1
+                delay = self.governor.get_retry_delay(attempt)
+                self.metrics.increment("halolink_retries_total", operation=operation)
+                logger.warning("HALOLink %s failed (%s), retry %d in %.1f s.", operation, repr(error), attempt, delay)
+                await asyncio.sleep(delay)
+
+    # The token is refreshed ahead of expiry, and requests that are safe to repeat are replayed once on a new
+    # socket if the connection drops.
+    async def execute_once(self, document, variable_values: dict, idempotent: bool, operation: str):
+        # Counted from the moment the session is picked, so requests waiting on the governor spread out too.
+        session = self.get_session(operation)
+        session.in_flight = session.in_flight + 1
+        try:
+            return await self.execute_on_session(session, document, variable_values, idempotent, operation)
+        finally:
+            session.in_flight = session.in_flight - 1
+
+    async def execute_on_session(self, session: HalolinkSession, document, variable_values: dict, idempotent: bool,
+                                 operation: str):
+        # Each socket was authenticated with the token current when it was opened.
+        if session.token_expires_at - time.time() < TOKEN_REFRESH_MARGIN:
+            await self.reconnect(session, session.generation)
+        generation = session.generation
+        try:
+            return await self.send(session, document, variable_values, operation)
+        except RECONNECT_ERRORS as error:
+            if not idempotent:
+                raise
+            logger.warning("HALOLink connection %s dropped (%s), reconnecting.", session.name, error)
+            await self.reconnect(session, generation)
+            return await self.send(session, document, variable_values, operation)
+
+    async def send(self, session: HalolinkSession, document, variable_values: dict, operation: str):
+        async with session.governor.request():
+            with self.metrics.time_stage("halolink_request", operation=operation):
+                result = await session.client_session.execute(document, variable_values=variable_values)
+        self.metrics.increment("halolink_session_requests_total", session=session.name)
+        if session.governor is self.governor:
+            self.metrics.set_gauge("halolink_concurrency_limit", self.governor.concurrency_limit)
+        else:
+            self.metrics.set_gauge("halolink_read_concurrency_limit", session.governor.concurrency_limit)
+        return result
 
     async def get_image_by_pk(self, primary_key: int) -> dict:
-        image = await self.client_session.execute(
-            gql("""
-            query imageByPk($pk: Int!) {
-              imageByPk(pk:$pk) {
-                id
-                location
-                tag
-                barcode
-                stain
-                fieldValues {
-                    pk
-                    id
-                    value
-                    type
-                    string
-                    text
-                    systemField {
-                       pk
-                       id
-                       name
-                       type
-                    }
-                }
-              }
-            }
-        """),
-            variable_values={"pk": primary_key}
-        )
+        image = await self.execute(IMAGE_BY_PK, variable_values={"pk": primary_key})
         return image
 
     async def get_images_in_study(self, study_pk: int):
-        study = await self.client_session.execute(
-            gql("""
-            query studyByPk($pk: Int!) {
-              studyByPk(pk:$pk) {
-                pk
-                id
-                name
-                studyImages {
-                  image {
-                    pk
-                    id
-                    location
-                    tag
-                    stain
-                    barcode
-                                    fieldValues {
-                                      value
-                                      systemField {
-                                        name
-                                      }
-                }
-                  }
-                }
-              }
-            }
-        """),
-            variable_values={"pk": study_pk}
-        )
+        study = await self.execute(STUDY_IMAGES, variable_values={"pk": study_pk})
         return study['studyByPk']['studyImages']
 
-    async def get_study_info(self, study_pk: int):
-        study = await self.client_session.execute(
-            gql("""
-        query studyByPk($pk: Int!) {
-          studyByPk(pk:$pk) {
-            pk
-            id
-            name
-            isSystem
-            isPublic
-            description
-            createdTime
-            permission
-            resolvedRole
-          }
-        }
-    """),
-            variable_values={"pk": study_pk}
+    # Same shape as get_images_in_study, but each image only has its pk, id and tag.
+    async def get_image_tags_in_study(self, study_pk: int) -> list:
+        study = await self.execute(STUDY_IMAGE_TAGS, variable_values={"pk": study_pk})
+        return study["studyByPk"]["studyImages"]
+
+    async def get_image_pks_in_study(self, study_pk: int) -> list:
+        return list(await self.get_image_versions_in_study(study_pk))
+
+    # Returns {image_pk: modifiedTime} for every image in the study, in listing order.
+    async def get_image_versions_in_study(self, study_pk: int) -> dict:
+        study = await self.execute(STUDY_IMAGE_PKS, variable_values={"pk": study_pk})
+        return {study_image["image"]["pk"]: study_image["image"]["modifiedTime"]
+                for study_image in study["studyByPk"]["studyImages"]}
+
+    # Returns the images in the same shape as the studyImages entries of get_images_in_study.
+    async def get_images_by_pks(self, image_pks: list) -> list:
+        if not image_pks:
+            return []
+        images = await self.execute(
+            get_images_by_pks_document(len(image_pks)),
+            variable_values={f"pk_{i}": image_pk for i, image_pk in enumerate(image_pks)}
         )
+        # Images moved out of the study since the listing come back empty.
+        return [{"image": images[f"image_{i}"]} for i in range(len(image_pks)) if images.get(f"image_{i}")]
+
+    # Yields the images of a study a page at a time so callers can start working before the whole
+    # study has been downloaded. Pass image_pks to only fetch some of the study's images.
+    async def iter_images_in_study(self, study_pk: int, page_size: int = DEFAULT_PAGE_SIZE, image_pks: list = None):
+        if image_pks is None:
+            image_pks = await self.get_image_pks_in_study(study_pk)
+        for i in range(0, len(image_pks), page_size):
+            yield await self.get_images_by_pks(image_pks[i:i + page_size])
+
+    async def get_study_info(self, study_pk: int):
+        study = await self.execute(STUDY_INFO, variable_values={"pk": study_pk})
         return study['studyByPk']
 
     async def update_stain(self, image_id: str, stain: str):
-        response = await self.client_session.execute(
-            gql("""
-            mutation($image_id: ID!, $stain: String) {
-                changeImageProperties(input: {
-                    imageId: $image_id,
-                    stain: $stain
-                })
-                {
-                mutated {
-                  node {
-                    pk
-                    id
-                    location
-                    tag
-                    stain
-                    barcode
-                    permission
-                    resolvedRole
-                    modifiedTime
-                    createdTime
-                  }
-                } 
-                }
-                }
-            """), variable_values={"image_id": image_id, "stain": stain}
+        response = await self.execute(
+            UPDATE_STAIN, variable_values={"image_id": image_id, "stain": stain}
         )
         return response
 
 
     #NOTE: This mutation uses the internal IDs NOT the integer primary keys.
     async def move_image(self, image_id: str, src_study_id: str, dest_study_id: str):
-        response = await self.client_session.execute(
-            gql("""
-             mutation($study_id: ID!, $image_id: ID!, $src_study_id: ID!){
-                  moveImageToStudy(input: {
-                    imageId: $image_id
-                    studyId: $study_id
-                    sourceStudyId: $src_study_id 
-                  })
-            {
-                mutated {
-                  node {
-                study {
-                studyImages {
-                  image {
-                    pk
-                    id
-                    location
-                    tag
-                    stain
-                    barcode
-                    permission
-                    resolvedRole
-                    modifiedTime
-                    createdTime
-                  }
-                }
-                }
-                  }
-                }
-              }
-              }
-              """),
-            variable_values={"image_id": image_id, "study_id": dest_study_id, "src_study_id": src_study_id}
+        response = await self.execute(
+            MOVE_IMAGE,
+            variable_values={"image_id": image_id, "study_id": dest_study_id, "src_study_id": src_study_id},
+            # A replayed move fails once the image has left the source study.
+            idempotent=False
         )
         return response
 
     async def set_image_fields(self, image_id: str, field_updates: list):
-        update_string = ""
-        for field_update in field_updates:
-            update_string = update_string + f",{{ operation: SET, systemFieldId: \"{field_update['field_enum'].value['id']}\", newValue: \"{field_update['value']}\"}}"
-        update_string = update_string[1:]
-        response = await self.client_session.execute(
-            gql("""
-             mutation($image_id: ID!){
-                  updateImageFieldValues (input: {
-                    imageId: $image_id
-                    updates: [
-                        """
-                        + update_string +
-                        """
-                    ]
-                  })
-            {
-                mutated {
-                  node {
-                    pk
-                    id
-                    value
-                    type
-                    string
-                    text
-                    systemField {
-                       pk
-                       id
-                       name
-                       type
-                    }
-                  }
-                }
-                }
-                }
-                """),
-            variable_values={"image_id": image_id}
+        response = await self.execute(
+            get_set_image_fields_document(len(field_updates)),
+            variable_values={"image_id": image_id, **get_field_value_variables(field_updates)}
         )
         return response
 
+    # Packs the stain, field and move mutations for several images into one aliased document. Each entry of
+    # image_updates has an image_id and any of "stain", "field_updates" and "move" ({"src_study_id", "dest_study_id"}).
+    # Returns one result per entry so a failure on one image doesn't hide the others.
+    async def batch_update_images(self, image_updates: list) -> list:
+        shape = []
+        variable_values = {}
+        for i, image_update in enumerate(image_updates):
+            stain = image_update.get("stain") is not None
+            fields = len(image_update.get("field_updates") or [])
+            move = bool(image_update.get("move"))
+            shape.append((stain, fields, move))
+            if stain or fields or move:
+                variable_values[f"image_id_{i}"] = image_update["image_id"]
+            if stain:
+                variable_values[f"stain_{i}"] = image_update["stain"]
+            if fields:
+                variable_values.update(get_field_value_variables(image_update["field_updates"], f"_{i}"))
+            if move:
+                variable_values[f"src_study_id_{i}"] = image_update["move"]["src_study_id"]
+                variable_values[f"dest_study_id_{i}"] = image_update["move"]["dest_study_id"]
+
+        data = {}
+        errors = []
+        if variable_values:
+            try:
+                data = await self.execute(get_batch_update_document(tuple(shape)), variable_values=variable_values,
+                                          idempotent=not any(move for stain, fields, move in shape))
+            except TransportQueryError as error:
+                data = error.data or {}
+                errors = error.errors or []
+            except (asyncio.TimeoutError, TransportServerError) + RECONNECT_ERRORS as error:
+                # Report the batch as failed instead of ending the run. A move that timed out or whose socket
+                # dropped may still have happened, so the image is left for the next run to pick up.
+                errors = [{"message": "HALOLink request failed: " + (str(error) or type(error).__name__)}]
 
+        results = []
+        for i, image_update in enumerate(image_updates):
+            aliases = [f"stain_{i}", f"fields_{i}", f"move_{i}"]
+            # Errors without a path (e.g. a rejected document) apply to every image in the batch.
+            image_errors = [error for error in errors if not error.get("path") or error["path"][0] in aliases]
+            results.append({
+                "image_id": image_update["image_id"],
+                "stain": data.get(f"stain_{i}"),
+                "fields": data.get(f"fields_{i}"),
+                "move": data.get(f"move_{i}"),
+                "errors": [error.get("message", str(error)) for error in image_errors],
+            })
+        return results
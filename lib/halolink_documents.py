@@ -0,0 +1,262 @@
+from functools import lru_cache
+from gql import gql
+
+# Parsed once at import and reused for every request. Values are always passed as variables so a
+# document never changes between images.
+
+STUDY_IMAGE_FIELDS = """
+                    pk
+                    id
+                    location
+                    tag
+                    stain
+                    barcode
+                    fieldValues {
+                      value
+                      systemField {
+                        name
+                      }
+                    }
+"""
+
+IMAGE_BY_PK = gql("""
+            query imageByPk($pk: Int!) {
+              imageByPk(pk:$pk) {
+                id
+                location
+                tag
+                barcode
+                stain
+                fieldValues {
+                    pk
+                    id
+                    value
+                    type
+                    string
+                    text
+                    systemField {
+                       pk
+                       id
+                       name
+                       type
+                    }
+                }
+              }
+            }
+        """)
+
+STUDY_IMAGES = gql("""
+            query studyByPk($pk: Int!) {
+              studyByPk(pk:$pk) {
+                pk
+                id
+                name
+                studyImages {
+                  image {""" + STUDY_IMAGE_FIELDS + """
+                  }
+                }
+              }
+            }
+        """)
+
+STUDY_IMAGE_PKS = gql("""
+            query studyByPk($pk: Int!) {
+              studyByPk(pk:$pk) {
+                studyImages {
+                  image {
+                    pk
+                    modifiedTime
+                  }
+                }
+              }
+            }
+        """)
+
+# Just enough of each image to group a study by biopsy.
+STUDY_IMAGE_TAGS = gql("""
+            query studyByPk($pk: Int!) {
+              studyByPk(pk:$pk) {
+                studyImages {
+                  image {
+                    pk
+                    id
+                    tag
+                  }
+                }
+              }
+            }
+        """)
+
+STUDY_INFO = gql("""
+        query studyByPk($pk: Int!) {
+          studyByPk(pk:$pk) {
+            pk
+            id
+            name
+            isSystem
+            isPublic
+            description
+            createdTime
+            permission
+            resolvedRole
+          }
+        }
+    """)
+
+UPDATE_STAIN = gql("""
+            mutation($image_id: ID!, $stain: String) {
+                changeImageProperties(input: {
+                    imageId: $image_id,
+                    stain: $stain
+                })
+                {
+                mutated {
+                  node {
+                    pk
+                    id
+                    location
+                    tag
+                    stain
+                    barcode
+                    permission
+                    resolvedRole
+                    modifiedTime
+                    createdTime
+                  }
+                }
+                }
+                }
+            """)
+
+#NOTE: This mutation uses the internal IDs NOT the integer primary keys.
+MOVE_IMAGE = gql("""
+             mutation($study_id: ID!, $image_id: ID!, $src_study_id: ID!){
+                  moveImageToStudy(input: {
+                    imageId: $image_id
+                    studyId: $study_id
+                    sourceStudyId: $src_study_id
+                  })
+            {
+                mutated {
+                  node {
+                study {
+                studyImages {
+                  image {
+                    pk
+                    id
+                    location
+                    tag
+                    stain
+                    barcode
+                    permission
+                    resolvedRole
+                    modifiedTime
+                    createdTime
+                  }
+                }
+                }
+                  }
+                }
+              }
+              }
+              """)
+
+# The updates list of updateImageFieldValues, written inline as it always was, with each entry's field ID and value
+# passed as scalar variables. The list's input type is never named, so the documents don't depend on what HALOLink
+# calls it. suffix keeps the variables of different images in a batch apart.
+def get_field_value_updates(count: int, suffix: str = "") -> tuple:
+    variable_definitions = []
+    updates = []
+    for j in range(count):
+        variable_definitions.append(f"$field_id{suffix}_{j}: ID!")
+        variable_definitions.append(f"$value{suffix}_{j}: String!")
+        updates.append(f"{{ operation: SET, systemFieldId: $field_id{suffix}_{j}, newValue: $value{suffix}_{j} }}")
+    return variable_definitions, "[" + ", ".join(updates) + "]"
+
+
+def get_field_value_variables(field_updates: list, suffix: str = "") -> dict:
+    variable_values = {}
+    for j, field_update in enumerate(field_updates):
+        variable_values[f"field_id{suffix}_{j}"] = field_update["field_enum"].value["id"]
+        variable_values[f"value{suffix}_{j}"] = str(field_update["value"])
+    return variable_values
+
+
+# Only a handful of update counts ever occur, so only a few of these are built.
+@lru_cache(maxsize=16)
+def get_set_image_fields_document(count: int):
+    variable_definitions, updates = get_field_value_updates(count)
+    return gql("""
+             mutation(""" + ", ".join(["$image_id: ID!"] + variable_definitions) + """){
+                  updateImageFieldValues (input: {
+                    imageId: $image_id
+                    updates: """ + updates + """
+                  })
+            {
+                mutated {
+                  node {
+                    pk
+                    id
+                    value
+                    type
+                    string
+                    text
+                    systemField {
+                       pk
+                       id
+                       name
+                       type
+                    }
+                  }
+                }
+                }
+                }
+                """)
+
+
+# Aliased imageByPk lookups for a page of images. Pages are almost always the same size, so only a
+# couple of these are ever built.
+@lru_cache(maxsize=16)
+def get_images_by_pks_document(count: int):
+    variable_definitions = []
+    queries = []
+    for i in range(count):
+        variable_definitions.append(f"$pk_{i}: Int!")
+        queries.append(f"""
+                image_{i}: imageByPk(pk: $pk_{i}) {{""" + STUDY_IMAGE_FIELDS + """
+                }""")
+    return gql("query(" + ", ".join(variable_definitions) + ") {" + "".join(queries) + "\n}")
+
+
+# Aliased stain, field and move mutations for a batch of images. The shape is a tuple with one
+# (stain, fields, move) tuple per image, saying which mutations that image needs. fields is the number of field
+# updates, the others are booleans.
+@lru_cache(maxsize=256)
+def get_batch_update_document(shape: tuple):
+    variable_definitions = []
+    mutations = []
+    for i, (stain, fields, move) in enumerate(shape):
+        if not (stain or fields or move):
+            continue
+        variable_definitions.append(f"$image_id_{i}: ID!")
+        if stain:
+            variable_definitions.append(f"$stain_{i}: String")
+            mutations.append(f"""
+                stain_{i}: changeImageProperties(input: {{ imageId: $image_id_{i}, stain: $stain_{i} }}) {{
+                    mutated {{ node {{ pk id stain }} }}
+                }}""")
+        if fields:
+            field_definitions, updates = get_field_value_updates(fields, f"_{i}")
+            variable_definitions.extend(field_definitions)
+            mutations.append(f"""
+                fields_{i}: updateImageFieldValues(input: {{ imageId: $image_id_{i}, updates: {updates} }}) {{
+                    mutated {{ node {{ pk id value systemField {{ name }} }} }}
+                }}""")
+        if move:
+            variable_definitions.append(f"$src_study_id_{i}: ID!")
+            variable_definitions.append(f"$dest_study_id_{i}: ID!")
+            mutations.append(f"""
+                move_{i}: moveImageToStudy(input: {{ imageId: $image_id_{i}, studyId: $dest_study_id_{i}, sourceStudyId: $src_study_id_{i} }}) {{
+                    mutated {{ node {{ study {{ pk id }} }} }}
+                }}""")
+    return gql("mutation(" + ", ".join(variable_definitions) + ") {" + "".join(mutations) + "\n}")
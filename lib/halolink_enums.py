@@ -0,0 +1,33 @@
+from enum import Enum
+
+
+class HLField(Enum):
+    STUDY_ID = {"id": "U3lzdGVtRmllbGQ6Mw==", "name": "StudyID"}
+    ORGAN = {"id": "U3lzdGVtRmllbGQ6MjE=", "name": "Organ"}
+    IMAGE_TYPE = {"id": "U3lzdGVtRmllbGQ6MTU=", "name": "Image_Type"}
+    BIOPSY_DATE = {"id": "U3lzdGVtRmllbGQ6Ng==", "name": "Biopsy_Date"}
+    NPT_PATIENT_STUDY_ID = {"id": "U3lzdGVtRmllbGQ6OQ==", "name": "NPT_PatientStudyID"}
+    CGN_PATIENT_STUDY_ID = {"id": "U3lzdGVtRmllbGQ6MTA=", "name": "CGN_PatientStudyID"}
+    DISEASE = {"id": "U3lzdGVtRmllbGQ6MTE=", "name": "Disease"}
+    BIOPSY_ID = {"id": "U3lzdGVtRmllbGQ6MTI=", "name": "BiopsyID"}
+    TISSUE_COMMENT = {"id": "U3lzdGVtRmllbGQ6MjI=", "name": "Tissue_Comment"}
+    EVENT_TYPE = {"id": "U3lzdGVtRmllbGQ6MTY=", "name": "Event_Type"}
+    LEVEL = {"id": "U3lzdGVtRmllbGQ6MTQ=", "name": "Level"}
+
+# Destination studies
+class HLStudyEscrow(Enum):
+    CUREGN_ESCROW_1 = {"pk": 9735, "id": "U3R1ZHk6OTczNQ==", "name": "CureGN Escrow 1"}
+    CUREGN_ESCROW_2 = {"pk": 9703, "id": "U3R1ZHk6OTcwMw==", "name": "CureGN Escrow 2"}
+    CUREGN_DIABETES_ESCROW_1 = {"pk": 9837, "id": "U3R1ZHk6OTgzNw==", "name": "CureGN Diabetes Escrow 1"}
+    CUREGN_DIABETES_ESCROW_2 = {"pk": 9838, "id": "U3R1ZHk6OTgzOA==", "name": "CureGN Diabetes Escrow 2"}
+    NEPTUNE_ESCROW_1 = {"pk": 9666, "id": "U3R1ZHk6OTY2Ng==", "name": "Neptune Escrow 1"}
+    NEPTUNE_ESCROW_2 = {"pk": 9696, "id": "U3R1ZHk6OTY5Ng==", "name": "Neptune Escrow 2"}
+
+# Source studies
+class HLStudy(Enum):
+    INCOMING_CUREGN = {"pk": 9783, "id": "U3R1ZHk6OTc4Mw==", "name": "Incoming CureGN", "escrow": False, "success_dest": HLStudyEscrow.CUREGN_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_ESCROW_1, "redcap_project": "curegn", "default_study": "CureGN"}
+    CUREGN_ESCROW_1 = {"pk": 9735, "id": "U3R1ZHk6OTczNQ==", "name": "CureGN Escrow 1",  "escrow": True, "success_dest": HLStudyEscrow.CUREGN_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_ESCROW_1, "redcap_project": "curegn", "default_study": "CureGN"}
+    INCOMING_CUREGN_DIABETES = {"pk": 10487, "id": "U3R1ZHk6MTA0ODc=", "name": "Incoming CureGN Diabetes",  "escrow": False, "success_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_1, "redcap_project": "curegn_diabetes", "default_study": "CureGN Diabetes"}
+    CUREGN_DIABETES_ESCROW_1 = {"pk": 9837, "id": "U3R1ZHk6OTgzNw==", "name": "CureGN Diabetes Escrow 1",  "escrow": True, "success_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_2, "failure_dest": HLStudyEscrow.CUREGN_DIABETES_ESCROW_1, "redcap_project": "curegn_diabetes", "default_study": "CureGN Diabetes"}
+    INCOMING_NEPTUNE = {"pk": 9784, "id": "U3R1ZHk6OTc4NA==", "name": "Incoming Neptune",  "escrow": False, "success_dest": HLStudyEscrow.NEPTUNE_ESCROW_2, "failure_dest": HLStudyEscrow.NEPTUNE_ESCROW_1, "redcap_project": "neptune", "default_study": "Neptune"}
+    NEPTUNE_ESCROW_1 = {"pk": 9666, "id": "U3R1ZHk6OTY2Ng==", "name": "Neptune Escrow 1",  "escrow": True, "success_dest": HLStudyEscrow.NEPTUNE_ESCROW_2, "failure_dest": HLStudyEscrow.NEPTUNE_ESCROW_1, "redcap_project": "neptune", "default_study": "Neptune"}
@@ -0,0 +1,14 @@
+import os
+import sqlite3
+
+DEFAULT_LOCAL_STORE_PATH = "pipeline_state.sqlite"
+# Seconds a write waits for another process holding the lock, e.g. the workers of a sharded run.
+LOCK_TIMEOUT = 30.0
+
+
+def get_local_store(path: str = None) -> sqlite3.Connection:
+    if path is None:
+        path = os.environ.get("pipeline_state_path") or DEFAULT_LOCAL_STORE_PATH
+    connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRIC_PREFIX = "miktmc_pipeline_"
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def get_metric_key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def get_prometheus_labels(labels: tuple, extra_labels: tuple = ()) -> str:
+    labels = labels + extra_labels
+    if not labels:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for key, value in labels]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+# Counters, gauges and latency histograms for one run of the pipeline. One instance is shared by the pipeline
+# service and the connections it uses. Updates are locked because Uploader lookups run in worker threads.
+class PipelineMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = get_metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[get_metric_key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = get_metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0, "max": 0.0}
+                self.histograms[key] = histogram
+            for i, bucket in enumerate(LATENCY_BUCKETS):
+                if seconds <= bucket:
+                    histogram["buckets"][i] = histogram["buckets"][i] + 1
+            histogram["count"] = histogram["count"] + 1
+            histogram["sum"] = histogram["sum"] + seconds
+            histogram["max"] = max(histogram["max"], seconds)
+
+    # Times the block as one call of the stage. Works around awaits too. Failed calls are also counted as errors.
+    @contextmanager
+    def time_stage(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment(name + "_errors_total", **labels)
+            raise
+        finally:
+            self.observe(name + "_duration_seconds", time.perf_counter() - start, **labels)
+
+    def record_cache(self, cache: str, hits: int, misses: int):
+        if hits:
+            self.increment("cache_requests_total", hits, cache=cache, result="hit")
+        if misses:
+            self.increment("cache_requests_total", misses, cache=cache, result="miss")
+
+    def record_bytes_received(self, service: str, num_bytes: int):
+        self.increment("bytes_received_total", num_bytes, service=service)
+
+    def get_counter_total(self, name: str, **labels) -> float:
+        with self.lock:
+            return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                       if counter_name == name and all((key, labels[key]) in counter_labels for key in labels))
+
+    # Gauges derived from the counters when the metrics are written.
+    def get_run_gauges(self) -> dict:
+        duration = time.time() - self.start_time
+        images = self.get_counter_total("images_total")
+        gauges = {
+            get_metric_key("run_start_timestamp_seconds", {}): self.start_time,
+            get_metric_key("run_duration_seconds", {}): duration,
+            get_metric_key("images_per_second", {}): images / duration if duration > 0 else 0.0,
+        }
+        caches = {dict(labels)["cache"] for name, labels in self.counters if name == "cache_requests_total"}
+        for cache in sorted(caches):
+            hits = self.get_counter_total("cache_requests_total", cache=cache, result="hit")
+            total = self.get_counter_total("cache_requests_total", cache=cache)
+            gauges[get_metric_key("cache_hit_ratio", {"cache": cache})] = hits / total if total else 0.0
+        with self.lock:
+            gauges.update(self.gauges)
+        return gauges
+
+    # Approximate quantile from the histogram buckets, reported as the upper bound of the bucket it falls in.
+    def get_quantile(self, histogram: dict, quantile: float) -> float:
+        rank = quantile * histogram["count"]
+        for bucket, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+            if count >= rank:
+                return bucket
+        return histogram["max"]
+
+    def get_summary(self) -> dict:
+        gauges = self.get_run_gauges()
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(histogram, buckets=list(histogram["buckets"]))
+                          for key, histogram in self.histograms.items()}
+        summary = {"counters": [], "gauges": [], "histograms": []}
+        for (name, labels), value in sorted(counters.items()):
+            summary["counters"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), value in sorted(gauges.items()):
+            summary["gauges"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), histogram in sorted(histograms.items()):
+            summary["histograms"].append({
+                "name": name,
+                "labels": dict(labels),
+                "count": histogram["count"],
+                "sum": histogram["sum"],
+                "mean": histogram["sum"] / histogram["count"],
+                "p50": self.get_quantile(histogram, 0.5),
+                "p95": self.get_quantile(histogram, 0.95),
+                "max": histogram["max"],
+                "buckets": dict(zip([str(bucket) for bucket in LATENCY_BUCKETS], histogram["buckets"])),
+            })
+        return summary
+
+    def get_prometheus_text(self) -> str:
+        summary = self.get_summary()
+        lines = []
+        types = set()
+
+        def add_type(name: str, metric_type: str):
+            if name not in types:
+                types.add(name)
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for counter in summary["counters"]:
+            name = METRIC_PREFIX + counter["name"]
+            add_type(name, "counter")
+            lines.append(name + get_prometheus_labels(tuple(counter["labels"].items())) + " " + repr(float(counter["value"])))
+        for gauge in summary["gauges"]:
+            name = METRIC_PREFIX + gauge["name"]
+            add_type(name, "gauge")
+            lines.append(name + get_prometheus_labels(tuple(gauge["labels"].items())) + " " + repr(float(gauge["value"])))
+        for histogram in summary["histograms"]:
+            name = METRIC_PREFIX + histogram["name"]
+            labels = tuple(histogram["labels"].items())
+            add_type(name, "histogram")
+            for bucket, count in histogram["buckets"].items():
+                lines.append(name + "_bucket" + get_prometheus_labels(labels, (("le", bucket),)) + " " + str(count))
+            lines.append(name + "_bucket" + get_prometheus_labels(labels, (("le", "+Inf"),)) + " " + str(histogram["count"]))
+            lines.append(name + "_sum" + get_prometheus_labels(labels) + " " + repr(histogram["sum"]))
+            lines.append(name + "_count" + get_prometheus_labels(labels) + " " + str(histogram["count"]))
+        return "\n".join(lines) + "\n"
+
+    # Written to a temporary file and renamed so a scraper never reads a half written file.
+    def write_file(self, path: str, content: str):
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(content)
+        os.replace(temp_path, path)
+
+    def write_json(self, path: str):
+        self.write_file(path, json.dumps(self.get_summary(), indent=2) + "\n")
+
+    def write_prometheus(self, path: str):
+        self.write_file(path, self.get_prometheus_text())
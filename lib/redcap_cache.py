@@ -0,0 +1,58 @@
+import json
+import os
+import time
+
+from lib.local_store import get_local_store
+
+# Seconds a REDCap export is served from the cache. Biopsies that weren't found expire sooner so new
+# REDCap entries get picked up quickly.
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_NEGATIVE_TTL = 60 * 60
+
+
+class RedcapCache:
+
+    def __init__(self, path: str = None, ttl: int = None, negative_ttl: int = None):
+        self.ttl = ttl if ttl is not None else int(os.environ.get("redcap_cache_ttl") or DEFAULT_TTL)
+        self.negative_ttl = negative_ttl if negative_ttl is not None else int(
+            os.environ.get("redcap_cache_negative_ttl") or DEFAULT_NEGATIVE_TTL)
+        self.connection = get_local_store(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS redcap_cache (
+                project TEXT NOT NULL,
+                biopsy_id TEXT NOT NULL,
+                records TEXT NOT NULL,
+                fetched_time REAL NOT NULL,
+                PRIMARY KEY (project, biopsy_id)
+            )""")
+        self.connection.commit()
+
+    # Returns the cached export rows for every biopsy ID that has a fresh entry. An empty list means
+    # the biopsy was looked up recently and not found.
+    def get_many(self, project: str, biopsy_ids: list) -> dict:
+        results = {}
+        now = time.time()
+        for biopsy_id in biopsy_ids:
+            row = self.connection.execute(
+                "SELECT records, fetched_time FROM redcap_cache WHERE project = ? AND biopsy_id = ?",
+                (project, biopsy_id)).fetchone()
+            if row is not None:
+                records = json.loads(row[0])
+                ttl = self.ttl if records else self.negative_ttl
+                if now - row[1] < ttl:
+                    results[biopsy_id] = records
+        return results
+
+    def put_many(self, project: str, results: dict):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO redcap_cache (project, biopsy_id, records, fetched_time) VALUES (?, ?, ?, ?)",
+            [(project, biopsy_id, json.dumps(records), now) for biopsy_id, records in results.items()])
+        self.connection.commit()
+
+    def clear(self, project: str = None):
+        if project is None:
+            self.connection.execute("DELETE FROM redcap_cache")
+        else:
+            self.connection.execute("DELETE FROM redcap_cache WHERE project = ?", (project,))
+        self.connection.commit()
@@ -1,18 +1,28 @@
+import asyncio
 import copy
+import json
 
 import requests
 import os
 import logging
 from dotenv import load_dotenv
 
+from lib.pipeline_metrics import PipelineMetrics
+from lib.redcap_cache import RedcapCache
+
 logger = logging.getLogger("lib-RedcapConnection")
 logging.basicConfig(level=logging.ERROR)
 
 REDCAP_HOST = "https://rc.rarediseasesnetwork.org/api/"
-DEFAULT_FIELD_LIST = ["subjectid", "pathdiseasecohort", "renalbxdate", "numems_qc", "numbarcodes",
+DEFAULT_FIELD_LIST = ["biopsyid", "subjectid", "pathdiseasecohort", "renalbxdate", "numems_qc", "numbarcodes",
                       "neptune_studyid_screen"]
 DEFAULT_EVENTS = []
 DEFAULT_FORMS = []
+# Number of biopsy IDs OR'ed together in a single filtered export.
+BIOPSY_ID_CHUNK_SIZE = 100
+# Maximum open connections to REDCap for the async client.
+DEFAULT_CONNECTION_LIMIT = 8
+KEEPALIVE_TIMEOUT = 30
 
 slide_nums = list(range(1, 21))
 slide_level_fields = []
@@ -34,6 +44,12 @@ DEFAULT_FIELD_LIST_NEPTUNE = copy.copy(DEFAULT_FIELD_LIST_CUREGN_DIABETES)
 DEFAULT_FIELD_LIST_NEPTUNE.remove('subjectid')
 DEFAULT_FIELD_LIST_NEPTUNE.remove('pathdiseasecohort')
 
+REDCAP_PROJECTS = {
+    "curegn": {"token_env": "redcap_token_curegn", "field_list": DEFAULT_FIELD_LIST},
+    "curegn_diabetes": {"token_env": "redcap_token_curegn_diabetes", "field_list": DEFAULT_FIELD_LIST_CUREGN_DIABETES},
+    "neptune": {"token_env": "redcap_token_neptune", "field_list": DEFAULT_FIELD_LIST_NEPTUNE},
+}
+
 def get_disease(code: str):
     disease_codes = {
         "1": "MCD",
@@ -72,23 +88,36 @@ def get_stain(code: int):
 
 class RedcapConnection:
 
-    def __init__(self):
+    def __init__(self, cache: RedcapCache = None, project: str = "curegn"):
         self.default_field_list = None
         self.token = None
+        self.project = None
+        self.cache = cache
+        # Exports fresh rows instead of reading the cache, but still stores them, e.g. for runs that attach metadata.
+        self.refresh_cache = False
+        self.requests_session = None
+        self.http_session = None
+        self.metrics = PipelineMetrics()
         load_dotenv(".env")
-        self.connect_curegn()
+        self.url = os.environ.get("redcap_url") or REDCAP_HOST
+        self.connection_limit = int(os.environ.get("redcap_connection_limit") or DEFAULT_CONNECTION_LIMIT)
+        self.connect_project(project)
+
+    # Each connection only talks to one project at a time. Use a separate connection per project when
+    # working with several projects at once instead of switching this one.
+    def connect_project(self, project: str):
+        self.project = project
+        self.token = os.environ.get(REDCAP_PROJECTS[project]["token_env"])
+        self.default_field_list = tuple(REDCAP_PROJECTS[project]["field_list"])
 
     def connect_curegn(self):
-        self.token = os.environ.get("redcap_token_curegn")
-        self.default_field_list = DEFAULT_FIELD_LIST
+        self.connect_project("curegn")
 
     def connect_curegn_diabetes(self):
-        self.token = os.environ.get("redcap_token_curegn_diabetes")
-        self.default_field_list = DEFAULT_FIELD_LIST_CUREGN_DIABETES
+        self.connect_project("curegn_diabetes")
 
     def connect_neptune(self):
-        self.token = os.environ.get("redcap_token_neptune")
-        self.default_field_list = DEFAULT_FIELD_LIST_NEPTUNE
+        self.connect_project("neptune")
 
     def add_fields(self, request_data: dict):
         i = 0
@@ -111,14 +140,49 @@ class RedcapConnection:
             i = i + 1
         return request_data
 
-    def send_request(self, request_data: dict) -> requests.Response:
+    def build_request(self, request_data: dict) -> dict:
         request_data["token"] = self.token
         request_data = self.add_fields(request_data)
         request_data = self.add_events(request_data)
         request_data = self.add_forms(request_data)
-        return requests.post(REDCAP_HOST, data=request_data)
+        return request_data
 
-    def export_records(self, request_data: dict) -> requests.Response:
+    def send_request(self, request_data: dict) -> requests.Response:
+        if self.requests_session is None:
+            self.requests_session = requests.Session()
+        with self.metrics.time_stage("redcap_request", project=self.project):
+            response = self.requests_session.post(self.url, data=self.build_request(request_data))
+        self.metrics.record_bytes_received("redcap", len(response.content))
+        return response
+
+    # The async client shares one keep-alive connection pool per REDCap connection so exports don't block the
+    # event loop that is also driving HALOLink.
+    async def open_http_session(self):
+        import aiohttp
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=KEEPALIVE_TIMEOUT),
+                raise_for_status=True
+            )
+        return self.http_session
+
+    async def close(self):
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+        if self.requests_session is not None:
+            self.requests_session.close()
+            self.requests_session = None
+
+    async def send_request_async(self, request_data: dict):
+        http_session = await self.open_http_session()
+        with self.metrics.time_stage("redcap_request", project=self.project):
+            async with http_session.post(self.url, data=self.build_request(request_data)) as response:
+                body = await response.read()
+        self.metrics.record_bytes_received("redcap", len(body))
+        return json.loads(body)
+
+    def get_export_request(self, request_data: dict) -> dict:
         request_data.update({
             "content": "record",
             "action": "export",
@@ -132,7 +196,13 @@ class RedcapConnection:
             "exportDataAccessGroups": "true",
             "returnFormat": "json",
         })
-        return self.send_request(request_data)
+        return request_data
+
+    def export_records(self, request_data: dict) -> requests.Response:
+        return self.send_request(self.get_export_request(request_data))
+
+    async def export_records_async(self, request_data: dict):
+        return await self.send_request_async(self.get_export_request(request_data))
 
     def get_filtered_records(self, filter_logic: str) -> str:
         request_data = {
@@ -141,6 +211,56 @@ class RedcapConnection:
         result = self.export_records(request_data).json()
         return result
 
+    async def get_filtered_records_async(self, filter_logic: str) -> list:
+        result = await self.export_records_async({"filterLogic": filter_logic})
+        return result
+
     def get_by_biopsy_id(self, biopsy_id: str) -> str:
-        result = self.get_filtered_records(f"[biopsyid]='{biopsy_id}'")
+        result = self.get_by_biopsy_ids([biopsy_id])[biopsy_id]
         return result
+
+    async def get_by_biopsy_id_async(self, biopsy_id: str) -> list:
+        result = await self.get_by_biopsy_ids_async([biopsy_id])
+        return result[biopsy_id]
+
+    # Fills results with fresh cache entries and returns the biopsy IDs that still need exporting.
+    def get_cached_records(self, results: dict) -> list:
+        cached_results = {}
+        if self.cache is not None and not self.refresh_cache:
+            cached_results = self.cache.get_many(self.project, list(results.keys()))
+            results.update(cached_results)
+            self.metrics.record_cache("redcap_local", len(cached_results), len(results) - len(cached_results))
+        return [biopsy_id for biopsy_id in results.keys() if biopsy_id not in cached_results]
+
+    def get_biopsy_id_filter(self, biopsy_ids: list) -> str:
+        return " or ".join(f"[biopsyid]='{biopsy_id}'" for biopsy_id in biopsy_ids)
+
+    def add_exported_records(self, results: dict, chunk: list, records: list):
+        for record in records:
+            if record["biopsyid"] in chunk:
+                results[record["biopsyid"]].append(record)
+
+    def cache_exported_records(self, results: dict, biopsy_ids: list):
+        if self.cache is not None and biopsy_ids:
+            self.cache.put_many(self.project, {biopsy_id: results[biopsy_id] for biopsy_id in biopsy_ids})
+
+    def get_by_biopsy_ids(self, biopsy_ids: list, chunk_size: int = BIOPSY_ID_CHUNK_SIZE) -> dict:
+        results = {biopsy_id: [] for biopsy_id in biopsy_ids}
+        biopsy_ids = self.get_cached_records(results)
+        for i in range(0, len(biopsy_ids), chunk_size):
+            chunk = biopsy_ids[i:i + chunk_size]
+            self.add_exported_records(results, chunk, self.get_filtered_records(self.get_biopsy_id_filter(chunk)))
+        self.cache_exported_records(results, biopsy_ids)
+        return results
+
+    # Same as get_by_biopsy_ids, but the chunks are exported concurrently over the pooled session.
+    async def get_by_biopsy_ids_async(self, biopsy_ids: list, chunk_size: int = BIOPSY_ID_CHUNK_SIZE) -> dict:
+        results = {biopsy_id: [] for biopsy_id in biopsy_ids}
+        biopsy_ids = self.get_cached_records(results)
+        chunks = [biopsy_ids[i:i + chunk_size] for i in range(0, len(biopsy_ids), chunk_size)]
+        exports = await asyncio.gather(*[self.get_filtered_records_async(self.get_biopsy_id_filter(chunk))
+                                         for chunk in chunks])
+        for chunk, records in zip(chunks, exports):
+            self.add_exported_records(results, chunk, records)
+        self.cache_exported_records(results, biopsy_ids)
+        return results
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+
+# Requests per second allowed by the token bucket and how many can be sent at once after a quiet spell.
+# A rate of 0 turns the rate limit off.
+DEFAULT_RATE_LIMIT = 20.0
+DEFAULT_BURST = 20
+# The concurrency limit starts here and moves between 1 and the maximum as responses come back.
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 16
+# Responses slower than this count as a sign of overload.
+DEFAULT_TARGET_LATENCY = 5.0
+DECREASE_FACTOR = 0.5
+DEFAULT_MAX_RETRIES = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# HTTP statuses HALOLink or a proxy in front of it use when it is overloaded. 429 means the request was rejected
+# before it ran.
+OVERLOAD_STATUS_CODES = (429, 502, 503, 504)
+THROTTLE_MESSAGES = ("too many requests", "rate limit", "throttl")
+
+
+def is_throttle_error(error: Exception) -> bool:
+    if not isinstance(error, TransportQueryError):
+        return False
+    messages = [str(query_error.get("message", "")) for query_error in error.errors or []] or [str(error)]
+    return any(throttle_message in message.lower() for message in messages for throttle_message in THROTTLE_MESSAGES)
+
+
+def is_overload_error(error: Exception) -> bool:
+    if isinstance(error, TransportServerError):
+        return error.code in OVERLOAD_STATUS_CODES
+    return isinstance(error, asyncio.TimeoutError) or is_throttle_error(error)
+
+
+# Controls how hard HalolinkConnection pushes HALOLink. Requests wait for a token from a token bucket and for a
+# slot under an AIMD concurrency limit. The limit grows by about one per round of fast responses, and halves on
+# timeouts, throttling or responses slower than the target latency.
+class RequestGovernor:
+
+    def __init__(self, rate_limit: float = None, burst: int = None, max_concurrency: int = None,
+                 target_latency: float = None, max_retries: int = None):
+        self.rate_limit = rate_limit if rate_limit is not None else float(
+            os.environ.get("halolink_rate_limit") or DEFAULT_RATE_LIMIT)
+        self.burst = burst if burst is not None else int(os.environ.get("halolink_burst") or DEFAULT_BURST)
+        self.max_concurrency = max_concurrency if max_concurrency is not None else int(
+            os.environ.get("halolink_max_concurrency") or DEFAULT_MAX_CONCURRENCY)
+        self.target_latency = target_latency if target_latency is not None else float(
+            os.environ.get("halolink_target_latency") or DEFAULT_TARGET_LATENCY)
+        self.max_retries = max_retries if max_retries is not None else int(
+            os.environ.get("halolink_max_retries") or DEFAULT_MAX_RETRIES)
+        self.concurrency_limit = float(min(DEFAULT_INITIAL_CONCURRENCY, self.max_concurrency))
+        self.in_flight = 0
+        self.slot_condition = asyncio.Condition()
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.bucket_lock = asyncio.Lock()
+        self.last_decrease = 0.0
+
+    async def take_token(self):
+        if self.rate_limit <= 0:
+            return
+        # Waiters queue on the lock so tokens are handed out in arrival order.
+        async with self.bucket_lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate_limit)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate_limit)
+
+    async def acquire(self):
+        async with self.slot_condition:
+            await self.slot_condition.wait_for(lambda: self.in_flight < int(self.concurrency_limit))
+            self.in_flight = self.in_flight + 1
+        try:
+            await self.take_token()
+        except BaseException:
+            await self.release(0.0, False)
+            raise
+
+    async def release(self, latency: float, overloaded: bool):
+        async with self.slot_condition:
+            self.in_flight = self.in_flight - 1
+            now = time.monotonic()
+            if overloaded or latency > self.target_latency:
+                # Requests sent before the last decrease are still coming back slow, so back off once per window.
+                if now - self.last_decrease > self.target_latency:
+                    self.concurrency_limit = max(1.0, self.concurrency_limit * DECREASE_FACTOR)
+                    self.last_decrease = now
+            else:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            self.slot_condition.notify_all()
+
+    # Wraps one request. Its latency and whether it failed from overload feed the concurrency limit.
+    @asynccontextmanager
+    async def request(self):
+        await self.acquire()
+        start = time.monotonic()
+        overloaded = False
+        try:
+            yield
+        except Exception as error:
+            overloaded = is_overload_error(error)
+            raise
+        finally:
+            await self.release(time.monotonic() - start, overloaded)
+
+    # Requests that are not idempotent, like moves, are only retried when HALOLink rejected them without running them.
+    def is_retryable(self, error: Exception, idempotent: bool) -> bool:
+        if isinstance(error, TransportServerError):
+            return error.code == 429 or (idempotent and error.code in OVERLOAD_STATUS_CODES)
+        if is_throttle_error(error):
+            return idempotent or not error.data
+        return idempotent and isinstance(error, asyncio.TimeoutError)
+
+    # Exponential backoff with full jitter so retries from concurrent batches don't arrive together.
+    def get_retry_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
@@ -0,0 +1,101 @@
+import os
+import time
+
+from lib.local_store import get_local_store
+
+RUN_STEPS = ["stain", "fields", "move"]
+# Seconds after it started that a run, finished or not, is deleted from the journal.
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+
+
+class RunJournal:
+
+    def __init__(self, path: str = None, max_age: int = None):
+        self.max_age = max_age if max_age is not None else int(
+            os.environ.get("run_journal_max_age") or DEFAULT_MAX_AGE)
+        self.connection = get_local_store(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                study_pk INTEGER NOT NULL,
+                started_time REAL NOT NULL,
+                finished_time REAL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS run_steps (
+                run_id INTEGER NOT NULL,
+                image_id TEXT NOT NULL,
+                step TEXT NOT NULL,
+                completed_time REAL NOT NULL,
+                PRIMARY KEY (run_id, image_id, step)
+            )""")
+        # Images whose every step is done, by PK, so a resumed run can leave them out before fetching them.
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS run_images (
+                run_id INTEGER NOT NULL,
+                image_pk INTEGER NOT NULL,
+                completed_time REAL NOT NULL,
+                PRIMARY KEY (run_id, image_pk)
+            )""")
+        self.connection.commit()
+
+    # Returns the ID of the last unfinished run for the study, or None.
+    def get_unfinished_run(self, study_pk: int):
+        row = self.connection.execute(
+            "SELECT run_id FROM runs WHERE study_pk = ? AND finished_time IS NULL ORDER BY run_id DESC LIMIT 1",
+            (study_pk,)).fetchone()
+        return row[0] if row is not None else None
+
+    # Returns the ID of the last unfinished run for the study when resuming, otherwise starts a new run.
+    def start_run(self, study_pk: int, resume: bool = False) -> int:
+        if resume:
+            run_id = self.get_unfinished_run(study_pk)
+            if run_id is not None:
+                return run_id
+        self.prune()
+        cursor = self.connection.execute("INSERT INTO runs (study_pk, started_time) VALUES (?, ?)",
+                                         (study_pk, time.time()))
+        self.connection.commit()
+        return cursor.lastrowid
+
+    # A finished run is never resumed, so only the run itself is kept.
+    def finish_run(self, run_id: int):
+        self.connection.execute("UPDATE runs SET finished_time = ? WHERE run_id = ?", (time.time(), run_id))
+        self.connection.execute("DELETE FROM run_steps WHERE run_id = ?", (run_id,))
+        self.connection.execute("DELETE FROM run_images WHERE run_id = ?", (run_id,))
+        self.connection.commit()
+
+    # Deletes runs older than max_age, including ones that never finished.
+    def prune(self):
+        cutoff = time.time() - self.max_age
+        old_runs = "SELECT run_id FROM runs WHERE started_time < ?"
+        self.connection.execute("DELETE FROM run_steps WHERE run_id IN (" + old_runs + ")", (cutoff,))
+        self.connection.execute("DELETE FROM run_images WHERE run_id IN (" + old_runs + ")", (cutoff,))
+        self.connection.execute("DELETE FROM runs WHERE started_time < ?", (cutoff,))
+        self.connection.commit()
+
+    def get_completed_steps(self, run_id: int) -> dict:
+        completed_steps = {}
+        for image_id, step in self.connection.execute("SELECT image_id, step FROM run_steps WHERE run_id = ?",
+                                                      (run_id,)):
+            completed_steps.setdefault(image_id, set()).add(step)
+        return completed_steps
+
+    # Steps are (image_id, step) tuples where step is one of RUN_STEPS.
+    def record_steps(self, run_id: int, steps: list):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO run_steps (run_id, image_id, step, completed_time) VALUES (?, ?, ?, ?)",
+            [(run_id, image_id, step, now) for image_id, step in steps])
+        self.connection.commit()
+
+    def get_finished_images(self, run_id: int) -> set:
+        return {image_pk for image_pk, in self.connection.execute("SELECT image_pk FROM run_images WHERE run_id = ?",
+                                                                   (run_id,))}
+
+    def record_finished_images(self, run_id: int, image_pks: list):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO run_images (run_id, image_pk, completed_time) VALUES (?, ?, ?)",
+            [(run_id, image_pk, now) for image_pk in image_pks])
+        self.connection.commit()
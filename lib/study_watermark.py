@@ -0,0 +1,77 @@
+import os
+import time
+
+from lib.local_store import get_local_store
+
+# Seconds between full sweeps of a study in incremental mode. REDCap changes don't touch an image's
+# modifiedTime, so images skipped as unchanged are still re-evaluated this often.
+DEFAULT_FULL_SWEEP_INTERVAL = 7 * 24 * 60 * 60
+
+
+# Remembers the modifiedTime each image had when it was last evaluated in a study, so incremental runs
+# only evaluate images that are new to the study or changed since.
+class StudyWatermark:
+
+    def __init__(self, path: str = None, full_sweep_interval: int = None):
+        self.full_sweep_interval = full_sweep_interval if full_sweep_interval is not None else int(
+            os.environ.get("full_sweep_interval") or DEFAULT_FULL_SWEEP_INTERVAL)
+        self.connection = get_local_store(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS image_watermarks (
+                study_pk INTEGER NOT NULL,
+                image_pk INTEGER NOT NULL,
+                modified_time TEXT,
+                evaluated_time REAL NOT NULL,
+                PRIMARY KEY (study_pk, image_pk)
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS study_sweeps (
+                study_pk INTEGER PRIMARY KEY,
+                swept_time REAL NOT NULL
+            )""")
+        self.connection.commit()
+
+    def get_evaluated_images(self, study_pk: int) -> dict:
+        return dict(self.connection.execute(
+            "SELECT image_pk, modified_time FROM image_watermarks WHERE study_pk = ?", (study_pk,)))
+
+    # Returns the PKs in image_versions ({image_pk: modifiedTime}) that are new or changed since they were evaluated.
+    def get_changed_images(self, study_pk: int, image_versions: dict) -> list:
+        evaluated_images = self.get_evaluated_images(study_pk)
+        return [image_pk for image_pk, modified_time in image_versions.items()
+                if image_pk not in evaluated_images or evaluated_images[image_pk] != modified_time]
+
+    # Images are (image_pk, modifiedTime) tuples.
+    def record_images(self, study_pk: int, images: list):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO image_watermarks (study_pk, image_pk, modified_time, evaluated_time) VALUES (?, ?, ?, ?)",
+            [(study_pk, image_pk, modified_time, now) for image_pk, modified_time in images])
+        self.connection.commit()
+
+    # Forgets images that have left the study, e.g. because they were moved out.
+    def remove_missing_images(self, study_pk: int, image_pks: list):
+        current_image_pks = set(image_pks)
+        missing_image_pks = [image_pk for image_pk in self.get_evaluated_images(study_pk)
+                             if image_pk not in current_image_pks]
+        self.connection.executemany("DELETE FROM image_watermarks WHERE study_pk = ? AND image_pk = ?",
+                                    [(study_pk, image_pk) for image_pk in missing_image_pks])
+        self.connection.commit()
+
+    def needs_full_sweep(self, study_pk: int) -> bool:
+        row = self.connection.execute("SELECT swept_time FROM study_sweeps WHERE study_pk = ?", (study_pk,)).fetchone()
+        return row is None or time.time() - row[0] >= self.full_sweep_interval
+
+    def record_full_sweep(self, study_pk: int):
+        self.connection.execute("INSERT OR REPLACE INTO study_sweeps (study_pk, swept_time) VALUES (?, ?)",
+                                (study_pk, time.time()))
+        self.connection.commit()
+
+    def clear(self, study_pk: int = None):
+        if study_pk is None:
+            self.connection.execute("DELETE FROM image_watermarks")
+            self.connection.execute("DELETE FROM study_sweeps")
+        else:
+            self.connection.execute("DELETE FROM image_watermarks WHERE study_pk = ?", (study_pk,))
+            self.connection.execute("DELETE FROM study_sweeps WHERE study_pk = ?", (study_pk,))
+        self.connection.commit()
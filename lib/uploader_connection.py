@@ -1,7 +1,13 @@
 import os
-import pymongo
 from dotenv import load_dotenv
 
+from lib.pipeline_metrics import PipelineMetrics
+
+# Number of file names resolved by a single aggregation.
+FILE_NAME_CHUNK_SIZE = 1000
+# Milliseconds to wait for the Mongo server before a query fails.
+DEFAULT_SERVER_SELECTION_TIMEOUT_MS = 30000
+
 
 class UploaderConnection:
     def __init__(self):
@@ -9,16 +15,53 @@ class UploaderConnection:
         self.host = os.environ.get("uploader_host")
         self.port = os.environ.get("uploader_port")
         self.database = os.environ.get("uploader_database")
+        self.server_selection_timeout_ms = int(os.environ.get("uploader_server_selection_timeout_ms")
+                                               or DEFAULT_SERVER_SELECTION_TIMEOUT_MS)
         self.mongo_session = None
+        self.metrics = PipelineMetrics()
 
+    # pymongo is only imported once a command needs the Uploader database. The client connects in the background.
     def get_mongo_connection(self):
+        import pymongo
         mongo_client = pymongo.MongoClient(
-            f"mongodb://{self.host}:{self.port}/", serverSelectionTimeoutMS=1200000
+            f"mongodb://{self.host}:{self.port}/", serverSelectionTimeoutMS=self.server_selection_timeout_ms
         )
         database = mongo_client[self.database]
         self.mongo_session = database
 
+    # Fails fast, within the server selection timeout, when the Uploader database can't be reached.
+    def ping(self):
+        with self.metrics.time_stage("uploader_query", query="ping"):
+            self.mongo_session.client.admin.command("ping")
+
     def get_record_by_file_name(self, file_name: str):
-        result = self.mongo_session.packages.find_one({"files": {"$elemMatch": {"$and": [{"fileName": file_name}]}}}, {"_id": 0, "study": 1, "packageType": 1})
+        with self.metrics.time_stage("uploader_query", query="find_one"):
+            result = self.mongo_session.packages.find_one({"files": {"$elemMatch": {"$and": [{"fileName": file_name}]}}}, {"_id": 0, "study": 1, "packageType": 1})
         return result
 
+    def get_records_by_file_names(self, file_names: list, chunk_size: int = FILE_NAME_CHUNK_SIZE) -> dict:
+        results = {file_name: None for file_name in file_names}
+        file_names = list(results.keys())
+        for i in range(0, len(file_names), chunk_size):
+            chunk = file_names[i:i + chunk_size]
+            pipeline = [
+                {"$match": {"files.fileName": {"$in": chunk}}},
+                {"$unwind": "$files"},
+                {"$match": {"files.fileName": {"$in": chunk}}},
+                {"$project": {"_id": 0, "fileName": "$files.fileName", "study": 1, "packageType": 1}},
+            ]
+            with self.metrics.time_stage("uploader_query", query="aggregate"):
+                for record in self.mongo_session.packages.aggregate(pipeline):
+                    # Keep the first package found, like find_one does.
+                    if results[record["fileName"]] is None:
+                        results[record["fileName"]] = {key: record[key] for key in ["study", "packageType"] if key in record}
+        return results
+
+    def has_file_name_index(self) -> bool:
+        for index in self.mongo_session.packages.index_information().values():
+            if index["key"][0][0] == "files.fileName":
+                return True
+        return False
+
+    def create_file_name_index(self) -> str:
+        return self.mongo_session.packages.create_index("files.fileName")
@@ -0,0 +1,122 @@
+import json
+import pickle
+import time
+import zlib
+
+from lib.local_store import get_local_store
+
+SHARD_PENDING = "pending"
+SHARD_CLAIMED = "claimed"
+SHARD_DONE = "done"
+SHARD_FAILED = "failed"
+
+
+# Stable across processes, unlike hash(), so every process agrees on which shard a biopsy belongs to.
+def get_shard(biopsy_id: str, shards: int) -> int:
+    return zlib.crc32(biopsy_id.encode()) % shards
+
+
+# Coordinates the worker processes of a sharded run through the local store. The parent adds a run with the images
+# of each shard, workers claim shards and write their report rows back, and the parent merges the rows in listing
+# order once every worker has exited.
+class WorkQueue:
+
+    def __init__(self, path: str = None):
+        self.connection = get_local_store(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS shard_runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                study_pk INTEGER NOT NULL,
+                created_time REAL NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS shards (
+                run_id INTEGER NOT NULL,
+                shard INTEGER NOT NULL,
+                images TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker INTEGER,
+                claimed_time REAL,
+                finished_time REAL,
+                summary TEXT,
+                error TEXT,
+                PRIMARY KEY (run_id, shard)
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS shard_rows (
+                run_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                shard INTEGER NOT NULL,
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                action TEXT NOT NULL,
+                result TEXT NOT NULL,
+                metadata BLOB NOT NULL,
+                PRIMARY KEY (run_id, position)
+            )""")
+        self.connection.commit()
+
+    # Each shard is a list of (image_pk, position) tuples, position being the image's place in the study listing.
+    def create_run(self, study_pk: int, shard_images: list) -> int:
+        cursor = self.connection.execute("INSERT INTO shard_runs (study_pk, created_time) VALUES (?, ?)",
+                                         (study_pk, time.time()))
+        run_id = cursor.lastrowid
+        self.connection.executemany("INSERT INTO shards (run_id, shard, images, status) VALUES (?, ?, ?, ?)",
+                                    [(run_id, shard, json.dumps(images), SHARD_PENDING)
+                                     for shard, images in enumerate(shard_images)])
+        self.connection.commit()
+        return run_id
+
+    # Returns (shard, {image_pk: position}) for the next unclaimed shard, or None once they have all been claimed.
+    # A single UPDATE, so two workers never claim the same shard.
+    def claim_shard(self, run_id: int, worker: int):
+        row = self.connection.execute("""
+            UPDATE shards SET status = ?, worker = ?, claimed_time = ?
+            WHERE run_id = ? AND shard = (
+                SELECT shard FROM shards WHERE run_id = ? AND status = ? ORDER BY shard LIMIT 1)
+            RETURNING shard, images""",
+                                      (SHARD_CLAIMED, worker, time.time(), run_id, run_id, SHARD_PENDING)).fetchone()
+        self.connection.commit()
+        if row is None:
+            return None
+        return row[0], {image_pk: position for image_pk, position in json.loads(row[1])}
+
+    # Rows are (position, folder, filename, action, result, ImageMetadata) tuples.
+    def add_rows(self, run_id: int, shard: int, rows: list):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO shard_rows (run_id, position, shard, folder, filename, action, result, metadata) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(run_id, position, shard, folder, filename, action, result, pickle.dumps(metadata))
+             for position, folder, filename, action, result, metadata in rows])
+        self.connection.commit()
+
+    def complete_shard(self, run_id: int, shard: int, summary: dict):
+        self.connection.execute("UPDATE shards SET status = ?, finished_time = ?, summary = ? WHERE run_id = ? AND shard = ?",
+                                (SHARD_DONE, time.time(), json.dumps(summary), run_id, shard))
+        self.connection.commit()
+
+    def fail_shard(self, run_id: int, shard: int, error: str):
+        self.connection.execute("UPDATE shards SET status = ?, finished_time = ?, error = ? WHERE run_id = ? AND shard = ?",
+                                (SHARD_FAILED, time.time(), error, run_id, shard))
+        self.connection.commit()
+
+    def get_shards(self, run_id: int) -> list:
+        return [{"shard": shard, "status": status, "worker": worker,
+                 "summary": json.loads(summary) if summary else None, "error": error}
+                for shard, status, worker, summary, error in self.connection.execute(
+                    "SELECT shard, status, worker, summary, error FROM shards WHERE run_id = ? ORDER BY shard",
+                    (run_id,))]
+
+    # Yields report rows in listing order, in the form report sinks take.
+    def iter_rows(self, run_id: int):
+        for folder, filename, action, result, metadata in self.connection.execute(
+                "SELECT folder, filename, action, result, metadata FROM shard_rows WHERE run_id = ? ORDER BY position",
+                (run_id,)):
+            yield {"folder": folder, "filename": filename, "metadata": pickle.loads(metadata), "action": action,
+                   "result": result}
+
+    def clear(self, run_id: int):
+        self.connection.execute("DELETE FROM shard_rows WHERE run_id = ?", (run_id,))
+        self.connection.execute("DELETE FROM shards WHERE run_id = ?", (run_id,))
+        self.connection.execute("DELETE FROM shard_runs WHERE run_id = ?", (run_id,))
+        self.connection.commit()
@@ -1,31 +1,149 @@
 import asyncio
+import io
+import logging
+import os
+import signal
+import sys
+from functools import cached_property
 from pprint import pprint
 import time
-from lib.redcap_connection import RedcapConnection
-from lib.halolink_connection import HalolinkConnection, HLField, HLStudy
-from lib.uploader_connection import UploaderConnection
-from services.halolink_service import parse_biopsy_id, HalolinkService
-from model.image_metadata import ImageMetadata
-from model.redcap_metadata import RedcapMetadata
-from services.pipeline_service import PipelineService
+from lib.halolink_enums import HLStudy
+from lib.pipeline_metrics import PipelineMetrics
+from services.action_plan import ActionPlan, read_action_plan
+from services.report_sink import open_report_sink, REPORT_FORMATS
 import argparse
 
-from services.redcap_service import RedcapService
+logger = logging.getLogger("main")
+
+# Seconds between polls of the incoming folders in watch mode.
+DEFAULT_WATCH_INTERVAL = 30
+# Longest a watch waits before trying an image left with errors again, unless the image is modified.
+WATCH_MAX_ERROR_BACKOFF = 60 * 60
+
+# argparse type for counts and intervals, which must be at least 1.
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer, got " + value)
+    return number
+
+
+SOURCE_FOLDERS = {
+    "CI": HLStudy.INCOMING_CUREGN,
+    "CE1": HLStudy.CUREGN_ESCROW_1,
+    "E1": HLStudy.CUREGN_ESCROW_1,
+    "CDI": HLStudy.INCOMING_CUREGN_DIABETES,
+    "CDE1": HLStudy.CUREGN_DIABETES_ESCROW_1,
+    "NI": HLStudy.INCOMING_NEPTUNE,
+    "NE1": HLStudy.NEPTUNE_ESCROW_1,
+}
 
 
 class Main:
+    # Connections and services, and the modules behind them, are only created when a command first uses them, so
+    # lookups like --biopsy_id or --print_token don't import gql or pymongo or connect to Mongo.
     def __init__(self):
-        self.redcap_connection = RedcapConnection()
-        self.halolink_connection = HalolinkConnection()
-        self.uploader_connection = UploaderConnection()
-        self.uploader_connection.get_mongo_connection()
-        self.halolink_service = HalolinkService(self.halolink_connection)
-        self.pipeline_service = PipelineService(self.halolink_connection, self.redcap_connection, self.uploader_connection)
-        self.redcap_service = RedcapService(self.redcap_connection)
+        self.metrics = PipelineMetrics()
+        self.metrics_json_path = os.environ.get("pipeline_metrics_json_path")
+        self.metrics_prom_path = os.environ.get("pipeline_metrics_prom_path")
+        self.use_redcap_cache = True
+        # Attach runs export fresh REDCap rows by default so stale values are never written to HALOLink.
+        self.refresh_redcap_cache = False
+        # Applied to the pipeline service when it is created, e.g. from the command line.
+        self.pipeline_options = {}
+
+    @cached_property
+    def redcap_connection(self):
+        from lib.redcap_cache import RedcapCache
+        from lib.redcap_connection import RedcapConnection
+        redcap_connection = RedcapConnection(RedcapCache() if self.use_redcap_cache else None)
+        redcap_connection.refresh_cache = self.refresh_redcap_cache
+        redcap_connection.metrics = self.metrics
+        return redcap_connection
+
+    @cached_property
+    def halolink_connection(self):
+        from lib.halolink_connection import HalolinkConnection
+        halolink_connection = HalolinkConnection()
+        halolink_connection.metrics = self.metrics
+        return halolink_connection
+
+    @cached_property
+    def uploader_connection(self):
+        from lib.uploader_connection import UploaderConnection
+        uploader_connection = UploaderConnection()
+        uploader_connection.get_mongo_connection()
+        uploader_connection.metrics = self.metrics
+        return uploader_connection
+
+    @cached_property
+    def halolink_service(self):
+        from services.halolink_service import HalolinkService
+        return HalolinkService(self.halolink_connection)
+
+    @cached_property
+    def redcap_service(self):
+        from services.redcap_service import RedcapService
+        return RedcapService(self.redcap_connection)
+
+    @cached_property
+    def pipeline_service(self):
+        from lib.run_journal import RunJournal
+        from lib.study_watermark import StudyWatermark
+        from services.pipeline_service import PipelineService
+        pipeline_service = PipelineService(self.halolink_connection, self.redcap_connection, self.uploader_connection,
+                                           run_journal=RunJournal(), study_watermark=StudyWatermark())
+        for option, value in self.pipeline_options.items():
+            setattr(pipeline_service, option, value)
+        pipeline_service.metrics = self.metrics
+        return pipeline_service
+
+    def is_created(self, name: str) -> bool:
+        return name in self.__dict__
+
+    def share_metrics(self, *instrumented):
+        for instance in instrumented:
+            instance.metrics = self.metrics
+
+    async def close(self):
+        if self.is_created("halolink_connection"):
+            await self.halolink_connection.close()
+        if self.is_created("redcap_connection"):
+            await self.redcap_connection.close()
+        if self.pipeline_options.get("report_sink") is not None:
+            self.pipeline_options["report_sink"].close()
+
+    # Metrics are written even when the run fails, so a failed nightly run still shows where it got to.
+    def write_metrics(self, success: bool):
+        self.metrics.set_gauge("run_success", 1 if success else 0)
+        if self.metrics_json_path:
+            self.metrics.write_json(self.metrics_json_path)
+        if self.metrics_prom_path:
+            self.metrics.write_prometheus(self.metrics_prom_path)
+
+    async def run_and_close(self, coroutine):
+        success = False
+        try:
+            result = await coroutine
+            success = True
+            return result
+        finally:
+            await self.close()
+            self.write_metrics(success)
+
+    def run(self, coroutine):
+        return asyncio.run(self.run_and_close(coroutine))
 
     async def connect_to_halolink(self):
-        await self.halolink_connection.request_access_token()
-        await self.halolink_connection.create_client_session()
+        await self.halolink_connection.connect()
+
+    def ping_uploader(self):
+        self.uploader_connection.ping()
+
+    # HALOLink (token and websocket) and Mongo don't depend on each other, so they are connected at the same time.
+    # Mongo is pinged in a thread because pymongo blocks.
+    async def connect_pipeline(self):
+        await asyncio.gather(self.connect_to_halolink(), asyncio.to_thread(self.ping_uploader))
 
     async def print_halolink_image_info(self, image_id: int):
         await self.connect_to_halolink()
@@ -37,13 +155,23 @@ class Main:
         study = await self.halolink_connection.get_study_info(study_pk)
         print(study)
 
-    def print_redcap_data_biopsy_id(self, biopsy_id: str):
-        redcap_metadata = self.redcap_service.get_image_metadata_by_biopsy_id(biopsy_id)
-        pprint(vars(redcap_metadata["parent_metadata"]))
-        for slide in redcap_metadata["images"]:
-            pprint(vars(slide))
+    async def print_redcap_data_biopsy_id(self, biopsy_id: str):
+        redcap_metadata = await self.redcap_service.get_image_metadata_by_biopsy_id_async(biopsy_id)
+        pprint(redcap_metadata["parent_metadata"].get_fields())
+        for slide in redcap_metadata["wsi_images"].values():
+            pprint(slide.get_fields())
             pprint(slide.get_halolink_updates())
 
+    # pymongo blocks, so the index is checked and created in a thread like the ping.
+    async def check_uploader_index(self, create: bool):
+        if await asyncio.to_thread(self.uploader_connection.has_file_name_index):
+            print("Uploader packages index on files.fileName exists.")
+        elif create:
+            index_name = await asyncio.to_thread(self.uploader_connection.create_file_name_index)
+            print("Created Uploader packages index " + index_name + ".")
+        else:
+            print("Uploader packages index on files.fileName is missing. Run with --uploader_index create to add it.")
+
     async def verify_slide_counts(self, biopsy_id: str, slide_type: str):
         await self.connect_to_halolink()
         if slide_type == "EM":
@@ -52,62 +180,324 @@ class Main:
             result = await self.pipeline_service.compare_slide_counts(biopsy_id)
         print("Slide counts match") if result else print("Slide counts do not match")
 
-    async def curegn_incoming_metadata_dry_run(self):
+    async def reconcile_slide_counts(self, src_study: HLStudy):
         await self.connect_to_halolink()
+        self.redcap_connection.connect_project(src_study.value["redcap_project"])
+        reconciliation = await self.pipeline_service.reconcile_slide_counts(src_study)
+        print("BiopsyID,WSIs in HALOLink,numbarcodes,EMs in HALOLink,numems_qc,Problem")
+        for mismatch in reconciliation["mismatches"]:
+            print(",".join("" if mismatch[key] is None else str(mismatch[key]) for key in
+                           ["biopsy_id", "halolink_wsi", "redcap_wsi", "halolink_em", "redcap_em", "problem"]))
+        print(str(reconciliation["images"]) + " images in " + str(reconciliation["biopsies"]) + " biopsies checked in "
+              + src_study.value["name"] + ", " + str(len(reconciliation["mismatches"])) + " mismatched.")
+
+    async def curegn_incoming_metadata_dry_run(self):
+        await self.connect_pipeline()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.INCOMING_CUREGN, "CureGN", True)
 
     async def curegn_escrow_1_metadata_dry_run(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.CUREGN_ESCROW_1,"CureGN", True)
 
     async def curegn_diabetes_incoming_metadata_dry_run(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         self.redcap_connection.connect_curegn_diabetes()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.INCOMING_CUREGN_DIABETES,"CureGN Diabetes", True)
 
     async def curegn_diabetes_escrow_1_metadata_dry_run(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         self.redcap_connection.connect_curegn_diabetes()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.CUREGN_DIABETES_ESCROW_1, "CureGN Diabetes", True)
 
     async def neptune_incoming_metadata_dry_run(self):
         self.redcap_connection.connect_neptune()
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.INCOMING_NEPTUNE, "Neptune", True)
 
     async def neptune_escrow_1_metadata_dry_run(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         self.redcap_connection.connect_neptune()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.NEPTUNE_ESCROW_1, "Neptune", True)
 
     async def attach_curegn_incoming_metadata(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.INCOMING_CUREGN, "CureGN", False)
 
     async def attach_curegn_escrow_1_metadata(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.CUREGN_ESCROW_1, "CureGN", False)
 
     async def attach_curegn_diabetes_incoming_metadata(self):
         self.redcap_connection.connect_curegn_diabetes()
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.INCOMING_CUREGN_DIABETES, "CureGN Diabetes", False)
 
     async def attach_curegn_diabetes_escrow_1_metadata(self):
         self.redcap_connection.connect_curegn_diabetes()
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.CUREGN_DIABETES_ESCROW_1, "CureGN Diabetes", False)
 
     async def attach_neptune_incoming_metadata(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         self.redcap_connection.connect_neptune()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.INCOMING_NEPTUNE, "Neptune", False)
 
     async def attach_neptune_escrow_1_metadata(self):
-        await self.connect_to_halolink()
+        await self.connect_pipeline()
         self.redcap_connection.connect_neptune()
         await self.pipeline_service.get_metadata_for_images_in_study(HLStudy.NEPTUNE_ESCROW_1, "Neptune", False)
 
+    # A pipeline service for one folder with the same settings as the main one, but its own REDCap connection.
+    def get_study_pipeline_service(self, study: HLStudy):
+        from lib.redcap_connection import RedcapConnection
+        from services.pipeline_service import PipelineService
+        redcap_connection = RedcapConnection(self.redcap_connection.cache, study.value["redcap_project"])
+        redcap_connection.refresh_cache = self.redcap_connection.refresh_cache
+        pipeline_service = PipelineService(self.halolink_connection, redcap_connection, self.uploader_connection,
+                                           self.pipeline_service.concurrency, self.pipeline_service.batch_size,
+                                           self.pipeline_service.page_size, self.pipeline_service.run_journal,
+                                           self.pipeline_service.study_watermark)
+        pipeline_service.resume = self.pipeline_service.resume
+        pipeline_service.incremental = self.pipeline_service.incremental
+        pipeline_service.full_sweep = self.pipeline_service.full_sweep
+        pipeline_service.report_sink = self.pipeline_service.report_sink
+        pipeline_service.streaming = self.pipeline_service.streaming
+        pipeline_service.output = io.StringIO()
+        self.share_metrics(redcap_connection, pipeline_service)
+        return pipeline_service
+
+    # Runs every source folder at once over one HALOLink session. Each folder gets its own REDCap connection so
+    # projects don't share a token or field list, and its report is printed once the folder is done.
+    async def all_metadata(self, dry_run: bool):
+        await self.connect_pipeline()
+        pipeline_services = {}
+        for study in HLStudy:
+            pipeline_services[study] = self.get_study_pipeline_service(study)
+
+        async def run_study(study: HLStudy):
+            pipeline_service = pipeline_services[study]
+            try:
+                await pipeline_service.get_metadata_for_images_in_study(study, study.value["default_study"], dry_run)
+            finally:
+                await pipeline_service.redcap_connection.close()
+            print(study.value["name"])
+            print(pipeline_service.output.getvalue())
+
+        await asyncio.gather(*[run_study(study) for study in HLStudy])
+        totals = {}
+        print("Folder,Processed,Updated,Unchanged,Failed,Left with errors,Skipped")
+        for study, pipeline_service in pipeline_services.items():
+            summary = pipeline_service.run_summary
+            print(",".join([study.value["name"]] + [str(summary[key]) for key in ["processed", "updated", "unchanged", "failed", "left", "skipped"]]))
+            for key, value in summary.items():
+                totals[key] = totals.get(key, 0) + value
+        print(",".join(["Total"] + [str(totals[key]) for key in ["processed", "updated", "unchanged", "failed", "left", "skipped"]]))
+
+    # Applies a plan written by a dry run with --plan. Only HALOLink is used, so no REDCap or Mongo connection is made.
+    # Returns False without applying anything if an image in the plan changed since the dry run.
+    async def apply_action_plan(self, path: str) -> bool:
+        from lib.run_journal import RunJournal
+        from services.pipeline_service import PipelineService, DEFAULT_APPLY_CONCURRENCY
+        action_plan = read_action_plan(path)
+        await self.connect_to_halolink()
+        pipeline_service = PipelineService(self.halolink_connection, None, None, run_journal=RunJournal())
+        for option, value in self.pipeline_options.items():
+            setattr(pipeline_service, option, value)
+        pipeline_service.metrics = self.metrics
+        stale_images = await pipeline_service.apply_action_plan(
+            action_plan, self.pipeline_options.get("concurrency", DEFAULT_APPLY_CONCURRENCY))
+        if stale_images:
+            print("Plan " + path + " is stale, nothing was applied. " + str(len(stale_images))
+                  + " images changed or left " + action_plan.src_study.value["name"] + " since the dry run, e.g. "
+                  + ", ".join(stale_images[:5]) + ". Run the dry run again for a new plan.")
+            return False
+        return True
+
+    # Splits a folder across worker processes by biopsy ID, so each biopsy's REDCap export and images stay in one
+    # process. Every worker has its own HALOLink session, REDCap pool and Mongo client. The parent lists the folder
+    # once, adds the shards to the work queue, and reports the rows the workers send back in listing order.
+    async def sharded_metadata(self, src_study: HLStudy, dry_run: bool, shards: int):
+        import multiprocessing
+        from lib.work_queue import WorkQueue, SHARD_DONE, get_shard
+        from services.halolink_service import parse_biopsy_id
+        from services.report_sink import TextReportSink
+        await self.connect_to_halolink()
+        study_images = await self.halolink_connection.get_image_tags_in_study(src_study.value["pk"])
+        shard_images = [[] for shard in range(shards)]
+        for position, study_image in enumerate(study_images):
+            image_name = study_image["image"]["tag"]
+            try:
+                biopsy_id = parse_biopsy_id(image_name)
+            except IndexError:
+                biopsy_id = image_name
+            shard_images[get_shard(biopsy_id, shards)].append((study_image["image"]["pk"], position))
+        work_queue = WorkQueue()
+        run_id = work_queue.create_run(src_study.value["pk"], shard_images)
+
+        pipeline_service = self.pipeline_service
+        worker_options = {option: value for option, value in self.pipeline_options.items() if option != "report_sink"}
+        # Decided once here so every shard of an incremental run agrees on whether this is a full sweep.
+        incremental = pipeline_service.incremental and pipeline_service.study_watermark is not None
+        full_sweep = True
+        if incremental:
+            full_sweep = pipeline_service.full_sweep or pipeline_service.study_watermark.needs_full_sweep(
+                src_study.value["pk"])
+            worker_options["full_sweep"] = full_sweep
+        journal_run_id = None
+        if not dry_run and pipeline_service.run_journal is not None:
+            journal_run_id = pipeline_service.run_journal.start_run(src_study.value["pk"], pipeline_service.resume)
+            worker_options["journal_run_id"] = journal_run_id
+
+        # Spawned rather than forked so workers don't inherit open sockets or SQLite connections.
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=run_shard_worker,
+                                     args=(run_id, src_study, dry_run, worker_options, self.use_redcap_cache,
+                                           self.refresh_redcap_cache))
+                     for shard in range(shards)]
+        for process in processes:
+            process.start()
+        await asyncio.gather(*[asyncio.to_thread(process.join) for process in processes])
+
+        pipeline_service.run_summary = {"processed": 0, "updated": 0, "unchanged": 0, "failed": 0, "left": 0,
+                                        "skipped": 0}
+        report_sink = pipeline_service.report_sink
+        if report_sink is None:
+            report_sink = TextReportSink(pipeline_service.output)
+        report_sink.write_header()
+        for row in work_queue.iter_rows(run_id):
+            report_sink.write(row)
+            pipeline_service.add_to_run_summary(row["result"], src_study)
+        report_sink.flush()
+        shard_states = work_queue.get_shards(run_id)
+        for shard_state in shard_states:
+            if shard_state["summary"] is not None:
+                pipeline_service.run_summary["skipped"] = (pipeline_service.run_summary["skipped"]
+                                                           + shard_state["summary"]["skipped"])
+        pipeline_service.print_run_summary(incremental, full_sweep)
+        # Rows of unfinished shards are kept in the work queue for a look, and the journal run is left open so
+        # --resume can pick it up.
+        unfinished = [shard_state for shard_state in shard_states if shard_state["status"] != SHARD_DONE]
+        if unfinished:
+            raise RuntimeError(str(len(unfinished)) + " of " + str(shards) + " shards did not finish: " + "; ".join(
+                "shard " + str(shard_state["shard"]) + " " + (shard_state["error"] or shard_state["status"])
+                for shard_state in unfinished))
+        if journal_run_id is not None:
+            pipeline_service.run_journal.finish_run(journal_run_id)
+        work_queue.clear(run_id)
+
+    # Runs in each worker process of a sharded run. Claims shards until none are left and writes their rows and
+    # summaries to the work queue.
+    async def process_shards(self, run_id: int, src_study: HLStudy, dry_run: bool):
+        from lib.work_queue import WorkQueue
+        from services.report_sink import WorkQueueReportSink
+        work_queue = WorkQueue()
+        await self.connect_pipeline()
+        self.redcap_connection.connect_project(src_study.value["redcap_project"])
+        pipeline_service = self.pipeline_service
+        pipeline_service.output = io.StringIO()
+        while True:
+            claimed = work_queue.claim_shard(run_id, os.getpid())
+            if claimed is None:
+                return
+            shard, positions = claimed
+            pipeline_service.image_pks = list(positions)
+            pipeline_service.report_sink = WorkQueueReportSink(work_queue, run_id, shard, positions)
+            try:
+                await pipeline_service.get_metadata_for_images_in_study(src_study, src_study.value["default_study"],
+                                                                        dry_run)
+            except Exception as error:
+                work_queue.fail_shard(run_id, shard, repr(error))
+                raise
+            work_queue.complete_shard(run_id, shard, pipeline_service.run_summary)
+
+    # Keeps the HALOLink session, REDCap pools and Mongo client open and attaches metadata to new or changed images in
+    # the incoming folders as they show up. Each poll is one light listing per folder, and a folder is only run when
+    # the watermark says something changed or a full sweep is due. Stops after the current poll on SIGINT or SIGTERM.
+    async def watch_incoming(self, interval: int):
+        await self.connect_pipeline()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signal_number, stop.set)
+        studies = [study for study in HLStudy if not study.value["escrow"]]
+        pipeline_services = {}
+        for study in studies:
+            pipeline_service = self.get_study_pipeline_service(study)
+            pipeline_service.incremental = True
+            pipeline_services[study] = pipeline_service
+        study_watermark = self.pipeline_service.study_watermark
+        # Images left with errors, e.g. because their biopsy isn't in REDCap yet, aren't watermarked. They are tried
+        # again after a delay that doubles each time, or as soon as HALOLink shows them modified, instead of
+        # triggering a pass and repeating their report rows on every poll. {image_pk: (modifiedTime, retry time,
+        # delay)} per study.
+        error_backoff = {study: {} for study in studies}
+        print("Watching " + ", ".join(study.value["name"] for study in studies) + " every " + str(interval) + " seconds.")
+        try:
+            while not stop.is_set():
+                processed = 0
+                for study in studies:
+                    pipeline_service = pipeline_services[study]
+                    backoff = error_backoff[study]
+                    try:
+                        image_versions = await self.halolink_connection.get_image_versions_in_study(study.value["pk"])
+                        poll_time = time.time()
+                        waiting = {image_pk for image_pk, (modified_time, retry_time, delay) in backoff.items()
+                                   if image_versions.get(image_pk) == modified_time and retry_time > poll_time}
+                        # Full sweeps evaluate every image, including the ones waiting to be tried again.
+                        full_sweep = pipeline_service.full_sweep or study_watermark.needs_full_sweep(study.value["pk"])
+                        if not full_sweep and all(image_pk in waiting for image_pk in
+                                                  study_watermark.get_changed_images(study.value["pk"], image_versions)):
+                            continue
+                        pipeline_service.study_image_versions = image_versions
+                        pipeline_service.image_pks = None if full_sweep else [
+                            image_pk for image_pk in image_versions if image_pk not in waiting]
+                        # Drop the REDCap and Uploader data kept from the last poll. Watch mode exports from REDCap
+                        # past the disk cache unless --attach_cache was given, so later REDCap edits are picked up.
+                        pipeline_service.redcap_data_cache = {}
+                        pipeline_service.uploader_data_cache = {}
+                        pipeline_service.output = io.StringIO()
+                        await pipeline_service.get_metadata_for_images_in_study(study, study.value["default_study"],
+                                                                                False)
+                    except Exception:
+                        logger.exception("Watching %s failed, retrying next poll.", study.value["name"])
+                        continue
+                    # --full_sweep only applies to the first pass.
+                    pipeline_service.full_sweep = False
+                    error_image_pks = set(pipeline_service.error_image_pks)
+                    for image_pk in list(backoff):
+                        if image_pk not in waiting and image_pk not in error_image_pks:
+                            del backoff[image_pk]
+                    for image_pk in error_image_pks:
+                        modified_time, retry_time, delay = backoff.get(image_pk, (None, 0, 0))
+                        delay = min(WATCH_MAX_ERROR_BACKOFF, delay * 2) if modified_time == image_versions.get(
+                            image_pk) else interval
+                        backoff[image_pk] = (image_versions.get(image_pk), poll_time + delay, delay)
+                    processed = processed + pipeline_service.run_summary["processed"]
+                    if pipeline_service.run_summary["processed"]:
+                        print(time.strftime("%Y-%m-%d %H:%M:%S") + " " + study.value["name"])
+                        print(pipeline_service.output.getvalue())
+                if processed:
+                    self.write_metrics(True)
+                try:
+                    await asyncio.wait_for(stop.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for pipeline_service in pipeline_services.values():
+                await pipeline_service.redcap_connection.close()
+
+
+# Entry point of a sharded run's worker processes. Metrics files are left to the parent.
+def run_shard_worker(run_id: int, src_study: HLStudy, dry_run: bool, pipeline_options: dict, use_redcap_cache: bool,
+                     refresh_redcap_cache: bool):
+    main = Main()
+    main.use_redcap_cache = use_redcap_cache
+    main.refresh_redcap_cache = refresh_redcap_cache
+    main.metrics_json_path = None
+    main.metrics_prom_path = None
+    main.pipeline_options = pipeline_options
+    main.run(main.process_shards(run_id, src_study, dry_run))
+
 
 if __name__ == "__main__":
     main = Main()
@@ -129,6 +519,25 @@ if __name__ == "__main__":
         choices=["CI", "CE1", "E1", "CDI", "CDE1", "NI", "NE1"],
         required=False,
     )
+    parser.add_argument(
+        "--all",
+        choices=["dry_run", "attach"],
+        help='Do a dry run of, or attach metadata for, every source folder at the same time and print a combined summary.',
+        required=False,
+    )
+    parser.add_argument(
+        "--watch",
+        required=False,
+        help='Run until stopped, attaching metadata to new or changed images in the incoming folders (CI, CDI, NI) within a poll interval of their arrival.',
+        action='store_true'
+    )
+    parser.add_argument(
+        "--interval",
+        type=positive_int,
+        default=DEFAULT_WATCH_INTERVAL,
+        help='Seconds between polls of the incoming folders with --watch.',
+        required=False,
+    )
     parser.add_argument(
         "-b",
         "--biopsy_id",
@@ -142,6 +551,13 @@ if __name__ == "__main__":
         help='Verifies the number of image in HALOLink match the number of images from REDCap. Requires biopsy_id option.',
         required=False,
     )
+    parser.add_argument(
+        "-r",
+        "--reconcile",
+        choices=["CI", "CE1", "E1", "CDI", "CDE1", "NI", "NE1"],
+        help='Compares the number of WSIs and EMs of every biopsy in the source folder with numbarcodes and numems_qc in REDCap and prints the biopsies that do not match.',
+        required=False,
+    )
     parser.add_argument(
         "-i",
         "--image_id",
@@ -154,6 +570,12 @@ if __name__ == "__main__":
         help='Given a study PK, prints study/folder information from HALOLink. Useful for getting the ID from the PK.',
         required=False,
     )
+    parser.add_argument(
+        "--uploader_index",
+        choices=["check", "create"],
+        help='Checks for the Uploader index on packages files.fileName used by the bulk file name lookup, or creates it if missing.',
+        required=False,
+    )
     parser.add_argument(
         "-t",
         "--print_token",
@@ -161,43 +583,170 @@ if __name__ == "__main__":
         help='Prints a HALOLink access token. (e.g. to use in a graphQL client)',
         action='store_true'
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=positive_int,
+        help='Number of batches of images to process at the same time when doing a dry run or attaching metadata.',
+        required=False,
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=positive_int,
+        help='Number of images whose HALOLink updates and moves are sent together when attaching metadata.',
+        required=False,
+    )
+    parser.add_argument(
+        "--page_size",
+        type=positive_int,
+        help='Number of images downloaded from HALOLink per request while paging through a study.',
+        required=False,
+    )
+    parser.add_argument(
+        "--plan",
+        help='With -d, also write what the dry run would do to each image (stain, field updates and destination folder) to this JSON file for --apply_plan.',
+        required=False,
+    )
+    parser.add_argument(
+        "--apply_plan",
+        help='Apply a plan file written by -d with --plan, sending only the HALOLink updates and moves. Refuses the plan if any of its images changed since the dry run. Uses --workers batches at a time (default 8).',
+        required=False,
+    )
+    parser.add_argument(
+        "--shards",
+        type=positive_int,
+        help='With -d or -a, split the source folder by biopsy ID across this many worker processes, each with its own HALOLink, REDCap and Uploader connections. The report is merged in listing order.',
+        required=False,
+    )
+    parser.add_argument(
+        "--resume",
+        required=False,
+        help='Resume the last unfinished attach run for the source folder, skipping stain, field and move updates it already completed.',
+        action='store_true'
+    )
+    parser.add_argument(
+        "--incremental",
+        required=False,
+        help='Only evaluate images that are new to the source folder or modified in HALOLink since they were last evaluated. Every folder still gets a full sweep every full_sweep_interval seconds (default one week).',
+        action='store_true'
+    )
+    parser.add_argument(
+        "--full_sweep",
+        required=False,
+        help='With --incremental, evaluate every image in the folder now and restart the full sweep interval.',
+        action='store_true'
+    )
+    parser.add_argument(
+        "--no_cache",
+        required=False,
+        help='Always export from REDCap instead of using the local REDCap cache.',
+        action='store_true'
+    )
+    parser.add_argument(
+        "--attach_cache",
+        required=False,
+        help='With -a, --all attach or --watch, use REDCap rows from the local cache (up to redcap_cache_ttl seconds old) instead of exporting fresh ones.',
+        action='store_true'
+    )
+    parser.add_argument(
+        "--report",
+        help='Write the dry run or attach report to this file instead of printing it. Summaries are still printed.',
+        required=False,
+    )
+    parser.add_argument(
+        "--report_format",
+        choices=REPORT_FORMATS,
+        default="csv",
+        help='Format of the --report file, one row or JSON object per image. Rows include the source folder and result (updated, unchanged, failed or left).',
+        required=False,
+    )
+    parser.add_argument(
+        "--metrics_json",
+        help='Write run metrics (stage latency histograms, request and image counts, cache hit rates, bytes received) as JSON to this file at exit.',
+        required=False,
+    )
+    parser.add_argument(
+        "--metrics_prom",
+        help='Write run metrics in Prometheus text format to this file at exit, e.g. for the node_exporter textfile collector.',
+        required=False,
+    )
     args = parser.parse_args()
-    if args.dry_run:
+    if args.plan and (not args.dry_run or args.shards):
+        parser.error("--plan needs -d and can't be used with --shards")
+    if args.metrics_json:
+        main.metrics_json_path = args.metrics_json
+    if args.metrics_prom:
+        main.metrics_prom_path = args.metrics_prom
+    if args.no_cache:
+        main.use_redcap_cache = False
+    elif (args.attach or args.all == "attach" or args.watch) and not args.attach_cache:
+        main.refresh_redcap_cache = True
+    # Left at the pipeline service defaults unless given.
+    for option in ["workers", "batch_size", "page_size"]:
+        if getattr(args, option) is not None:
+            main.pipeline_options["concurrency" if option == "workers" else option] = getattr(args, option)
+    main.pipeline_options["resume"] = args.resume
+    main.pipeline_options["incremental"] = args.incremental
+    main.pipeline_options["full_sweep"] = args.full_sweep
+    # The CLI never uses the per-image results, so don't keep them.
+    main.pipeline_options["streaming"] = True
+    if args.plan:
+        main.pipeline_options["action_plan"] = ActionPlan(SOURCE_FOLDERS[args.dry_run])
+    if args.report:
+        main.pipeline_options["report_sink"] = open_report_sink(args.report, args.report_format)
+    if args.shards and (args.dry_run or args.attach):
+        main.run(main.sharded_metadata(SOURCE_FOLDERS[args.dry_run or args.attach], bool(args.dry_run), args.shards))
+    elif args.dry_run:
         if args.dry_run == "CE1" or args.dry_run == "E1":
-            asyncio.run(main.curegn_escrow_1_metadata_dry_run())
+            main.run(main.curegn_escrow_1_metadata_dry_run())
         elif args.dry_run == "CI":
-            asyncio.run(main.curegn_incoming_metadata_dry_run())
+            main.run(main.curegn_incoming_metadata_dry_run())
         elif args.dry_run == "CDI":
-            asyncio.run(main.curegn_diabetes_incoming_metadata_dry_run())
+            main.run(main.curegn_diabetes_incoming_metadata_dry_run())
         elif args.dry_run == "CDE1":
-            asyncio.run(main.curegn_diabetes_escrow_1_metadata_dry_run())
+            main.run(main.curegn_diabetes_escrow_1_metadata_dry_run())
         elif args.dry_run == "NI":
-            asyncio.run(main.neptune_incoming_metadata_dry_run())
+            main.run(main.neptune_incoming_metadata_dry_run())
         elif args.dry_run == "NE1":
-            asyncio.run(main.neptune_escrow_1_metadata_dry_run())
+            main.run(main.neptune_escrow_1_metadata_dry_run())
+        if args.plan:
+            main.pipeline_options["action_plan"].write(args.plan)
+            print("Wrote a plan for " + str(len(main.pipeline_options["action_plan"].images)) + " images to "
+                  + args.plan + ".")
     elif args.attach:
         if args.attach == "CE1" or args.attach == "E1":
-            asyncio.run(main.attach_curegn_escrow_1_metadata())
+            main.run(main.attach_curegn_escrow_1_metadata())
         elif args.attach == "CI":
-            asyncio.run(main.attach_curegn_incoming_metadata())
+            main.run(main.attach_curegn_incoming_metadata())
         elif args.attach == "CDI":
-            asyncio.run(main.attach_curegn_diabetes_incoming_metadata())
+            main.run(main.attach_curegn_diabetes_incoming_metadata())
         elif args.attach == "CDE1":
-            asyncio.run(main.attach_curegn_diabetes_escrow_1_metadata())
+            main.run(main.attach_curegn_diabetes_escrow_1_metadata())
         elif args.attach == "NI":
-            asyncio.run(main.attach_neptune_incoming_metadata())
+            main.run(main.attach_neptune_incoming_metadata())
         elif args.attach == "NE1":
-            asyncio.run(main.attach_neptune_escrow_1_metadata())
+            main.run(main.attach_neptune_escrow_1_metadata())
+    elif args.apply_plan:
+        if not main.run(main.apply_action_plan(args.apply_plan)):
+            sys.exit(1)
+    elif args.all:
+        main.run(main.all_metadata(args.all == "dry_run"))
+    elif args.watch:
+        main.run(main.watch_incoming(args.interval))
+    elif args.reconcile:
+        main.run(main.reconcile_slide_counts(SOURCE_FOLDERS[args.reconcile]))
     elif args.count:
-        asyncio.run(main.verify_slide_counts(args.biopsy_id, args.count))
+        main.run(main.verify_slide_counts(args.biopsy_id, args.count))
     elif args.biopsy_id:
-        main.print_redcap_data_biopsy_id(args.biopsy_id)
+        main.run(main.print_redcap_data_biopsy_id(args.biopsy_id))
     elif args.image_id:
-        asyncio.run(main.print_halolink_image_info(int(args.image_id)))
+        main.run(main.print_halolink_image_info(int(args.image_id)))
     elif args.study_pk:
-        asyncio.run(main.print_study_info(int(args.study_pk)))
+        main.run(main.print_study_info(int(args.study_pk)))
+    elif args.uploader_index:
+        main.run(main.check_uploader_index(args.uploader_index == "create"))
     elif args.print_token:
-        asyncio.run(main.connect_to_halolink())
+        main.run(main.halolink_connection.ensure_access_token())
         print(main.halolink_connection.access_token)
     else:
         print("Please choose an option. Run with --help for a list of options.")
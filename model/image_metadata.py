@@ -1,9 +1,40 @@
-from lib.halolink_connection import HLField
+from operator import attrgetter
+
+from lib.halolink_enums import HLField
 from lib.redcap_connection import get_disease, get_stain
-from model.redcap_metadata import RedcapMetadata
+from model.redcap_metadata import RedcapMetadata, VALIDATED_FIELDS as PARENT_VALIDATED_FIELDS
+
+# Fields sent to HALOLink, in the order they are sent and printed in reports. Each entry is the HALOLink field,
+# whether its value lives on the image or on its parent biopsy, and the attribute that holds it.
+UPDATE_FIELDS = (
+    (HLField.STUDY_ID, "parent", "study_id"),
+    (HLField.DISEASE, "parent", "disease"),
+    (HLField.IMAGE_TYPE, "image", "image_type"),
+    (HLField.NPT_PATIENT_STUDY_ID, "parent", "npt_patient_study_id"),
+    (HLField.CGN_PATIENT_STUDY_ID, "parent", "cgn_patient_study_id"),
+    (HLField.ORGAN, "parent", "organ"),
+    (HLField.TISSUE_COMMENT, "parent", "tissue_comment"),
+    (HLField.EVENT_TYPE, "parent", "event_type"),
+    (HLField.LEVEL, "image", "level"),
+    (HLField.BIOPSY_DATE, "parent", "biopsy_date"),
+    (HLField.BIOPSY_ID, "parent", "biopsy_id"),
+)
+METADATA_HEADER = "Barcode,Stain," + ",".join(field.value["name"] for field, owner, name in UPDATE_FIELDS) + ",Error Message"
+# Image fields that must have a value. Only WSIs carry slide level metadata.
+VALIDATED_FIELDS = ("image_type",)
+WSI_VALIDATED_FIELDS = ("level", "barcode", "slide_stain", "image_type")
+
+get_update_image_values = attrgetter(*[name for field, owner, name in UPDATE_FIELDS if owner == "image"])
+get_update_parent_values = attrgetter(*[name for field, owner, name in UPDATE_FIELDS if owner == "parent"])
 
 
 class ImageMetadata:
+    # The update list and report row are cached along with the values they were built from, so they are rebuilt
+    # whenever the image or its parent changes.
+    __slots__ = ("parent_metadata", "level", "barcode", "slide_stain", "image_type", "in_error", "missing_metadata",
+                 "error_message", "cached_updates_key", "cached_updates", "cached_update_string_key",
+                 "cached_update_string")
+
     def __init__(self, parent_metadata: RedcapMetadata = None):
         self.parent_metadata = parent_metadata
         self.level = ""
@@ -13,6 +44,10 @@ class ImageMetadata:
         self.in_error = False
         self.missing_metadata = False
         self.error_message = ""
+        self.cached_updates_key = None
+        self.cached_updates = None
+        self.cached_update_string_key = None
+        self.cached_update_string = None
 
     def fill_wsi_with_redcap_result(self, redcap_result: dict, slide_num: int):
         self.level = redcap_result["slidelevel" + str(slide_num)]
@@ -24,27 +59,22 @@ class ImageMetadata:
             self.slide_stain = ""
 
 
-    def get_halolink_updates(self):
-        return [
-            {"field_enum": HLField.STUDY_ID, "value": self.parent_metadata.study_id},
-            {"field_enum": HLField.DISEASE, "value": self.parent_metadata.disease},
-            {"field_enum": HLField.IMAGE_TYPE, "value": self.image_type},
-            {"field_enum": HLField.NPT_PATIENT_STUDY_ID, "value": self.parent_metadata.npt_patient_study_id},
-            {"field_enum": HLField.CGN_PATIENT_STUDY_ID, "value": self.parent_metadata.cgn_patient_study_id},
-            {"field_enum": HLField.ORGAN, "value": self.parent_metadata.organ},
-            {"field_enum": HLField.TISSUE_COMMENT, "value": self.parent_metadata.tissue_comment},
-            {"field_enum": HLField.EVENT_TYPE, "value": self.parent_metadata.event_type},
-            {"field_enum": HLField.LEVEL, "value": self.level},
-            {"field_enum": HLField.BIOPSY_DATE, "value": self.parent_metadata.biopsy_date},
-            {"field_enum": HLField.BIOPSY_ID, "value": self.parent_metadata.biopsy_id},
-        ]
+    def get_updates_key(self) -> tuple:
+        return get_update_image_values(self), get_update_parent_values(self.parent_metadata)
+
+    def get_halolink_updates(self) -> tuple:
+        updates_key = self.get_updates_key()
+        if updates_key != self.cached_updates_key:
+            image_values = iter(updates_key[0])
+            parent_values = iter(updates_key[1])
+            self.cached_updates = tuple(
+                {"field_enum": field, "value": next(image_values) if owner == "image" else next(parent_values)}
+                for field, owner, name in UPDATE_FIELDS)
+            self.cached_updates_key = updates_key
+        return self.cached_updates
 
     def get_metadata_header_string(self):
-        field_str = "Barcode,Stain"
-        hl_updates = self.get_halolink_updates()
-        for field in hl_updates:
-            field_str = field_str + "," + field["field_enum"].value["name"]
-        return field_str + ",Error Message"
+        return METADATA_HEADER
 
     def get_metadata_update_string(self):
         hl_updates = self.get_halolink_updates()
@@ -54,40 +84,34 @@ class ImageMetadata:
         return ",".join(field_list)
 
     def get_metadata_update_string_plain(self):
-        hl_updates = self.get_halolink_updates()
-        field_list = [str(self.barcode), str(self.slide_stain)]
-        for field in hl_updates:
-            if "," in field["value"]:
-                field_list.append("\"" + str(field["value"])+ "\"")
-            else:
-                field_list.append(str(field["value"]))
-        update_string = ",".join(field_list)
-        update_string = update_string + "," + "\"" + self.error_message + "\""
-        return update_string
+        update_string_key = (self.get_updates_key(), self.barcode, self.slide_stain, self.error_message)
+        if update_string_key != self.cached_update_string_key:
+            field_list = [str(self.barcode), str(self.slide_stain)]
+            for field in self.get_halolink_updates():
+                if "," in field["value"]:
+                    field_list.append("\"" + str(field["value"])+ "\"")
+                else:
+                    field_list.append(str(field["value"]))
+            update_string = ",".join(field_list)
+            self.cached_update_string = update_string + "," + "\"" + self.error_message + "\""
+            self.cached_update_string_key = update_string_key
+        return self.cached_update_string
 
     def validate_metadata(self):
-        validation_exemptions = ["error_message", "npt_patient_study_id", "cgn_patient_study_id", "em_count"]
-        fields = {}
         missing_fields = []
         # We only have to validate all of the image metadata if it's a WSI. Otherwise just check image type.
-        if self.image_type == "WSImage":
-            fields = vars(self)
-        else:
-            fields["image_type"] = self.image_type
-        fields = fields | vars(self.parent_metadata)
-        for name, value in fields.items():
-            if not name.startswith("__") and not callable(value) and name not in validation_exemptions:
+        image_fields = WSI_VALIDATED_FIELDS if self.image_type == "WSImage" else VALIDATED_FIELDS
+        for owner, names in ((self, image_fields), (self.parent_metadata, PARENT_VALIDATED_FIELDS)):
+            for name in names:
+                value = getattr(owner, name)
                 if value is None or value == "":
                     self.missing_metadata = True
                     missing_fields.append(name)
-        if fields["npt_patient_study_id"] == "" and fields["cgn_patient_study_id"] == "":
+        if self.parent_metadata.npt_patient_study_id == "" and self.parent_metadata.cgn_patient_study_id == "":
             self.missing_metadata = True
             missing_fields.append("patient_study_id")
         if self.missing_metadata:
             self.error_message = self.error_message + "WARNING: field(s) " + ",".join(missing_fields) + " are/is missing."
 
-
-
-
-
-
+    def get_fields(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if not name.startswith("cached_")}
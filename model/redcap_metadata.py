@@ -1,7 +1,14 @@
 from lib.redcap_connection import get_disease
 
 
+# Biopsy fields that must have a value for an image's metadata to be complete.
+VALIDATED_FIELDS = ("biopsy_id", "study_id", "organ", "biopsy_date", "disease", "tissue_comment", "event_type")
+
+
 class RedcapMetadata:
+    __slots__ = ("biopsy_id", "em_count", "study_id", "organ", "biopsy_date", "npt_patient_study_id",
+                 "cgn_patient_study_id", "disease", "tissue_comment", "event_type")
+
     def __init__(self, biopsy_id: str):
         self.biopsy_id = biopsy_id
         self.em_count = 0
@@ -24,3 +31,6 @@ class RedcapMetadata:
             self.npt_patient_study_id = redcap_result["neptune_studyid_screen"]
         self.em_count = redcap_result["numems_qc"]
         self.biopsy_date = redcap_result["renalbxdate"]
+
+    def get_fields(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
@@ -0,0 +1,91 @@
+import json
+import os
+import time
+
+from lib.halolink_enums import HLField, HLStudy, HLStudyEscrow
+from model.image_metadata import ImageMetadata, UPDATE_FIELDS
+from model.redcap_metadata import RedcapMetadata
+
+PLAN_VERSION = 1
+# (owner, attribute) of each HALOLink field, for rebuilding an image's metadata from a plan.
+FIELD_ATTRIBUTES = {field.name: (owner, name) for field, owner, name in UPDATE_FIELDS}
+
+
+# What a dry run would do to each image of a folder: the stain, the field updates and the folder it would be moved
+# to, along with the modifiedTime the image had when it was listed. Written as JSON so it can be reviewed, then
+# applied with --apply_plan without reading REDCap or the Uploader database again.
+class ActionPlan:
+
+    def __init__(self, src_study: HLStudy, created_time: float = None, images: list = None):
+        self.src_study = src_study
+        self.created_time = created_time if created_time is not None else time.time()
+        self.images = images if images is not None else []
+
+    # Images left in the folder with errors have nothing to apply and aren't added.
+    def add(self, plan: dict, modified_time: str):
+        if plan["metadata"].in_error:
+            return
+        changes = plan["changes"]
+        if changes["stain"] is None and not changes["field_updates"] and plan["dest_study"] is None:
+            return
+        image = plan["image"]["image"]
+        self.images.append({
+            "pk": image["pk"],
+            "id": image["id"],
+            "tag": image["tag"],
+            "modified_time": modified_time,
+            "stain": changes["stain"],
+            "field_updates": [{"field": field_update["field_enum"].name, "value": field_update["value"]}
+                              for field_update in changes["field_updates"]],
+            "dest_study": plan["dest_study"].name if plan["dest_study"] is not None else None,
+            "action": plan["action"],
+            # Everything the report shows for the image, so applying the plan reports the same rows as the dry run.
+            "metadata": {"barcode": plan["metadata"].barcode, "stain": plan["metadata"].slide_stain,
+                         "error_message": plan["metadata"].error_message,
+                         "fields": [{"field": update["field_enum"].name, "value": update["value"]}
+                                    for update in plan["metadata"].get_halolink_updates()]},
+        })
+
+    def get_image_metadata(self, image: dict) -> ImageMetadata:
+        image_metadata = ImageMetadata(RedcapMetadata(""))
+        image_metadata.barcode = image["metadata"]["barcode"]
+        image_metadata.slide_stain = image["metadata"]["stain"]
+        image_metadata.error_message = image["metadata"]["error_message"]
+        for field_value in image["metadata"]["fields"]:
+            owner, name = FIELD_ATTRIBUTES[field_value["field"]]
+            setattr(image_metadata if owner == "image" else image_metadata.parent_metadata, name, field_value["value"])
+        return image_metadata
+
+    # Plans in the shape PipelineService.apply_plans takes.
+    def get_plans(self) -> list:
+        return [{"image": {"image": {"pk": image["pk"], "id": image["id"], "tag": image["tag"]}},
+                 "changes": {"stain": image["stain"],
+                             "field_updates": [{"field_enum": HLField[field_update["field"]],
+                                                "value": field_update["value"]}
+                                               for field_update in image["field_updates"]]},
+                 "dest_study": HLStudyEscrow[image["dest_study"]] if image["dest_study"] is not None else None,
+                 "metadata": self.get_image_metadata(image), "action": image["action"], "errors": []}
+                for image in self.images]
+
+    # Returns the file names of planned images that left the folder or were modified after the dry run listed
+    # them. image_versions is {image_pk: modifiedTime} for the folder as it is now. Images in applied_image_ids
+    # were changed by an earlier apply of the plan, so they aren't checked.
+    def get_stale_images(self, image_versions: dict, applied_image_ids: set = frozenset()) -> list:
+        return [image["tag"] for image in self.images if image["id"] not in applied_image_ids and
+                (image["pk"] not in image_versions or image_versions[image["pk"]] != image["modified_time"])]
+
+    def write(self, path: str):
+        content = json.dumps({"version": PLAN_VERSION, "created_time": self.created_time,
+                              "study": self.src_study.name, "images": self.images}, indent=1)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(content + "\n")
+        os.replace(temp_path, path)
+
+
+def read_action_plan(path: str) -> ActionPlan:
+    with open(path) as file:
+        content = json.load(file)
+    if content.get("version") != PLAN_VERSION:
+        raise ValueError("Unsupported plan version " + str(content.get("version")) + " in " + path)
+    return ActionPlan(HLStudy[content["study"]], content["created_time"], content["images"])
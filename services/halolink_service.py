@@ -3,25 +3,111 @@ from array import array
 from lib.halolink_connection import HalolinkConnection
 from model.image_metadata import ImageMetadata
 
+# Anything with one of these in its file name isn't a WSI.
+NON_WSI_EXTENSIONS = ['jpg', 'JPG', 'tif', 'JPEG']
+
+
 def parse_biopsy_id(image_name: str):
     split_image = image_name.split("_")
     return split_image[0] + "_" + split_image[1]
 
 
+# WSIs get slide level metadata and are counted against numbarcodes in REDCap.
+def is_wsi_image(image_name: str) -> bool:
+    return all(extension not in image_name for extension in NON_WSI_EXTENSIONS)
+
+
+# Counted against numems_qc in REDCap.
+def is_em_image(image_name: str) -> bool:
+    return '.jpg' in image_name
+
+
+# A study listing indexed by biopsy. Every tag is parsed and classified once, so per-biopsy lookups don't rescan
+# or re-download the study. Images whose tag has no biopsy ID are kept in unparsed_images.
+class StudySnapshot:
+
+    def __init__(self, study_pk: int, study_images: list):
+        self.study_pk = study_pk
+        self.study_images = study_images
+        self.biopsies = {}
+        self.unparsed_images = []
+        for study_image in study_images:
+            image_name = study_image["image"]["tag"]
+            try:
+                biopsy_id = parse_biopsy_id(image_name)
+            except IndexError:
+                self.unparsed_images.append(study_image)
+                continue
+            biopsy = self.biopsies.get(biopsy_id)
+            if biopsy is None:
+                biopsy = {"wsi": [], "em": [], "other": []}
+                self.biopsies[biopsy_id] = biopsy
+            if is_em_image(image_name):
+                biopsy["em"].append(study_image)
+            elif is_wsi_image(image_name):
+                biopsy["wsi"].append(study_image)
+            else:
+                biopsy["other"].append(study_image)
+
+    def get_biopsy_ids(self) -> list:
+        return list(self.biopsies)
+
+    # The biopsy's EM images, or its WSIs. Other images, like slide copies, are never returned, the same as in
+    # get_counts.
+    def get_images(self, biopsy_id: str, EM: bool = False) -> list:
+        biopsy = self.biopsies.get(biopsy_id)
+        if biopsy is None:
+            return []
+        return list(biopsy["em"] if EM else biopsy["wsi"])
+
+    def get_counts(self, biopsy_id: str) -> dict:
+        biopsy = self.biopsies.get(biopsy_id, {"wsi": [], "em": [], "other": []})
+        return {kind: len(images) for kind, images in biopsy.items()}
+
+
 class HalolinkService:
 
     def __init__(self, halolink_connection: HalolinkConnection):
         self.halolink_connection = halolink_connection
+        self.study_snapshots = {}
+
+    # Each study is listed once, with only the pk, id and tag of its images, and reused for the rest of the run
+    # unless refresh is set.
+    async def get_study_snapshot(self, study_pk: int, refresh: bool = False) -> StudySnapshot:
+        if refresh or study_pk not in self.study_snapshots:
+            self.study_snapshots[study_pk] = StudySnapshot(
+                study_pk, await self.halolink_connection.get_image_tags_in_study(study_pk))
+        return self.study_snapshots[study_pk]
 
     async def get_images_by_biopsy_id(self, study_pk: int, biopsy_id: str, EM: bool = False) -> list:
-        images = await self.halolink_connection.get_images_in_study(study_pk)
-        filtered_images = []
-        for image in images:
-            if biopsy_id + "_" in image['image']['tag'] and EM == ('.jpg' in image['image']['tag']):
-                filtered_images.append(image)
-        return filtered_images
-
-    async def update_image_metadata(self, image_id: str, image_metadata: ImageMetadata):
-        results = [await self.halolink_connection.update_stain(image_id, image_metadata.slide_stain),
-                   await self.halolink_connection.set_image_fields(image_id, image_metadata.get_halolink_updates())]
-        return results
+        snapshot = await self.get_study_snapshot(study_pk)
+        return snapshot.get_images(biopsy_id, EM)
+
+    # Compares the metadata we want on an image with what the study listing says is already there. The stain is None
+    # when it already matches and only the fields whose values differ are returned.
+    def get_image_changes(self, halolink_image: dict, image_metadata: ImageMetadata) -> dict:
+        current_values = {}
+        for field_value in halolink_image.get("fieldValues") or []:
+            current_values[field_value["systemField"]["name"]] = field_value["value"]
+        field_updates = []
+        for field_update in image_metadata.get_halolink_updates():
+            current_value = current_values.get(field_update["field_enum"].value["name"])
+            if str(current_value or "") != str(field_update["value"] or ""):
+                field_updates.append(field_update)
+        stain = image_metadata.slide_stain
+        if (halolink_image.get("stain") or "") == (stain or ""):
+            stain = None
+        return {"stain": stain, "field_updates": field_updates}
+
+    # Each entry is an image ID and the changes from get_image_changes. Images without changes send nothing.
+    async def update_images_metadata(self, image_changes: list) -> list:
+        return await self.halolink_connection.batch_update_images([
+            {"image_id": image_id, "stain": changes["stain"], "field_updates": changes["field_updates"]}
+            for image_id, changes in image_changes
+        ])
+
+    async def move_images(self, image_moves: list) -> list:
+        return await self.halolink_connection.batch_update_images([
+            {"image_id": image_id, "move": {"src_study_id": src_study_id, "dest_study_id": dest_study_id}}
+            for image_id, src_study_id, dest_study_id in image_moves
+        ])
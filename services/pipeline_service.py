@@ -1,33 +1,122 @@
+import asyncio
+import collections
+import copy
+import sys
+import time
+
 from lib.redcap_connection import RedcapConnection
-from lib.halolink_connection import HalolinkConnection, HLStudy
+from lib.halolink_connection import HalolinkConnection, HLStudy, DEFAULT_PAGE_SIZE
+from lib.pipeline_metrics import PipelineMetrics
+from lib.run_journal import RunJournal
+from lib.study_watermark import StudyWatermark
 from lib.uploader_connection import UploaderConnection
 from model.image_metadata import ImageMetadata
 from model.redcap_metadata import RedcapMetadata
-from services.halolink_service import HalolinkService, parse_biopsy_id
+from services.action_plan import ActionPlan
+from services.halolink_service import HalolinkService, StudySnapshot, parse_biopsy_id, is_wsi_image
 from services.redcap_service import RedcapService
+from services.report_sink import TextReportSink
+
+# Number of batches processed at the same time when attaching metadata.
+DEFAULT_CONCURRENCY = 1
+# Number of images whose HALOLink mutations are sent together in one GraphQL document.
+DEFAULT_BATCH_SIZE = 20
+# Batches sent at the same time when applying a plan. Only mutations are sent, and the request governor still
+# caps how many reach HALOLink at once.
+DEFAULT_APPLY_CONCURRENCY = 8
 
 
 class PipelineService:
     def __init__(self, halolink_connection: HalolinkConnection, redcap_connection: RedcapConnection,
-                 uploader_connection: UploaderConnection):
+                 uploader_connection: UploaderConnection, concurrency: int = DEFAULT_CONCURRENCY,
+                 batch_size: int = DEFAULT_BATCH_SIZE, page_size: int = DEFAULT_PAGE_SIZE,
+                 run_journal: RunJournal = None, study_watermark: StudyWatermark = None):
         self.halolink_connection = halolink_connection
         self.redcap_connection = redcap_connection
         self.halolink_service = HalolinkService(self.halolink_connection)
         self.redcap_service = RedcapService(self.redcap_connection)
         self.uploader_connection = uploader_connection
         self.redcap_data_cache = {}
+        self.uploader_data_cache = {}
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.run_summary = {}
+        self.run_journal = run_journal
+        self.resume = False
+        self.run_id = None
+        self.completed_steps = {}
+        self.study_watermark = study_watermark
+        self.incremental = False
+        self.full_sweep = False
+        # Restricts a run to these image PKs, e.g. one shard of a sharded run.
+        self.image_pks = None
+        # {image_pk: modifiedTime} of the study if the caller just listed it, e.g. a watch poll. Used by the next
+        # incremental run instead of listing the study again.
+        self.study_image_versions = None
+        # PKs of the images the last run failed or left with errors.
+        self.error_image_pks = []
+        # Journal run shared by every shard of a sharded run. The parent process starts and finishes it.
+        self.journal_run_id = None
+        # Dry runs add what they would do to each image to this plan.
+        self.action_plan = None
+        self.output = sys.stdout
+        # Without a report sink, rows are printed to output in the original text format.
+        self.report_sink = None
+        # When streaming, rows only go to the report and nothing is kept per image once it has been written.
+        self.streaming = False
+        self.metrics = PipelineMetrics()
+
+    # Returns the (numbarcodes, numems_qc) counts of a biopsy's REDCap export rows, or None if it wasn't found.
+    def get_redcap_slide_counts(self, redcap_result: list):
+        if not redcap_result:
+            return None
+        redcap_record = redcap_result[0]
+        return (int(redcap_record['numbarcodes']) if redcap_record['numbarcodes'] else 0,
+                int(redcap_record['numems_qc']) if redcap_record['numems_qc'] else 0)
 
+    # Counted the same way as reconcile_slide_counts: WSIs against numbarcodes, EM images against numems_qc.
     async def compare_slide_counts(self, biopsy_id: str):
-        halolink_slides = await self.halolink_service.get_incoming_curegn_images_by_biopsy_id(biopsy_id)
-        redcap_slides = self.redcap_connection.get_by_biopsy_id(biopsy_id)
-        numbarcodes = int(redcap_slides[0]['numbarcodes']) if redcap_slides[0]['numbarcodes'] else 0
-        return len(halolink_slides) == numbarcodes
+        snapshot = await self.halolink_service.get_study_snapshot(HLStudy.INCOMING_CUREGN.value["pk"])
+        redcap_counts = self.get_redcap_slide_counts(await self.redcap_connection.get_by_biopsy_id_async(biopsy_id))
+        return redcap_counts is not None and snapshot.get_counts(biopsy_id)["wsi"] == redcap_counts[0]
 
     async def compare_em_slide_counts(self, biopsy_id: str):
-        halolink_slides = await self.halolink_service.get_escrow_1_images_by_biopsy_id(biopsy_id)
-        redcap_slides = self.redcap_connection.get_by_biopsy_id(biopsy_id)
-        numems = int(redcap_slides[0]['numems_qc']) if redcap_slides[0]['numems_qc'] else 0
-        return len(halolink_slides) == numems
+        snapshot = await self.halolink_service.get_study_snapshot(HLStudy.CUREGN_ESCROW_1.value["pk"])
+        redcap_counts = self.get_redcap_slide_counts(await self.redcap_connection.get_by_biopsy_id_async(biopsy_id))
+        return redcap_counts is not None and snapshot.get_counts(biopsy_id)["em"] == redcap_counts[1]
+
+    # Checks every biopsy in a folder in one pass: one lightweight listing of the folder indexed by biopsy, and
+    # chunked REDCap exports for the counts. Returns the number of images and biopsies checked and a row for every
+    # biopsy whose counts don't match. Images that are neither WSIs nor EMs, like slide copies, aren't counted.
+    async def reconcile_slide_counts(self, src_study: HLStudy) -> dict:
+        snapshot = StudySnapshot(src_study.value["pk"],
+                                 await self.halolink_connection.get_image_tags_in_study(src_study.value["pk"]))
+        mismatches = []
+        for study_image in snapshot.unparsed_images:
+            mismatches.append({"biopsy_id": "", "halolink_wsi": None, "redcap_wsi": None, "halolink_em": None,
+                               "redcap_em": None, "problem": "No biopsy ID in file name " + study_image["image"]["tag"]})
+
+        redcap_results = await self.redcap_connection.get_by_biopsy_ids_async(snapshot.get_biopsy_ids())
+        for biopsy_id in snapshot.get_biopsy_ids():
+            counts = snapshot.get_counts(biopsy_id)
+            halolink_wsi = counts["wsi"]
+            halolink_em = counts["em"]
+            redcap_counts = self.get_redcap_slide_counts(redcap_results[biopsy_id])
+            row = {"biopsy_id": biopsy_id, "halolink_wsi": halolink_wsi, "redcap_wsi": None,
+                   "halolink_em": halolink_em, "redcap_em": None}
+            if redcap_counts is None:
+                mismatches.append(dict(row, problem="Biopsy ID not found in REDCap"))
+                continue
+            row["redcap_wsi"], row["redcap_em"] = redcap_counts
+            problems = []
+            if halolink_wsi != row["redcap_wsi"]:
+                problems.append("WSI count does not match")
+            if halolink_em != row["redcap_em"]:
+                problems.append("EM count does not match")
+            if problems:
+                mismatches.append(dict(row, problem=", ".join(problems)))
+        return {"images": len(snapshot.study_images), "biopsies": len(snapshot.biopsies), "mismatches": mismatches}
 
     async def add_metadata_one_image(self, image_pk: int):
         halolink_image = await self.halolink_connection.get_image_by_pk(image_pk)
@@ -35,30 +124,53 @@ class PipelineService:
         await self.halolink_connection.set_image_fields(halolink_image["id"], image_metadata.get_halolink_updates())
         await self.halolink_connection.update_stain(halolink_image["id"], image_metadata.slide_stain)
 
+    async def prefetch_redcap_data(self, images: list):
+        biopsy_ids = {}
+        for image in images:
+            biopsy_id = parse_biopsy_id(image["image"]["tag"])
+            if biopsy_id not in self.redcap_data_cache:
+                biopsy_ids[biopsy_id] = True
+        if biopsy_ids:
+            with self.metrics.time_stage("stage", stage="prefetch_redcap"):
+                self.redcap_data_cache.update(
+                    await self.redcap_service.get_image_metadata_by_biopsy_ids_async(list(biopsy_ids)))
+
+    async def prefetch_uploader_data(self, images: list):
+        file_names = [image["image"]["tag"] for image in images if image["image"]["tag"] not in self.uploader_data_cache]
+        if file_names:
+            with self.metrics.time_stage("stage", stage="prefetch_uploader"):
+                self.uploader_data_cache.update(
+                    await asyncio.to_thread(self.uploader_connection.get_records_by_file_names, file_names))
+
     async def get_metadata_for_image(self, halolink_image: dict, default_study: str) -> ImageMetadata:
         image_name = halolink_image["image"]["tag"]
         image_barcode = halolink_image["image"]["barcode"]
         biopsy_id = parse_biopsy_id(image_name)
         image_metadata = ImageMetadata(RedcapMetadata(biopsy_id))
         if biopsy_id not in self.redcap_data_cache:
-            redcap_data = self.redcap_service.get_image_metadata_by_biopsy_id(biopsy_id)
+            self.metrics.record_cache("redcap_prefetch", 0, 1)
+            redcap_data = await self.redcap_service.get_image_metadata_by_biopsy_id_async(biopsy_id)
         else:
+            self.metrics.record_cache("redcap_prefetch", 1, 0)
             redcap_data = self.redcap_data_cache[biopsy_id]
 
         if redcap_data:
-            is_wsi = all(extension not in image_name for extension in ['jpg', 'JPG', 'tif', 'JPEG'])
+            is_wsi = is_wsi_image(image_name)
             for image_field in halolink_image["image"]["fieldValues"]:
                 if "Disease" in image_field["systemField"]["name"]:
                     image_metadata.error_message = "WARNING: Some metadata already exists. "
 
+            # Work on copies so images of the same biopsy processed concurrently don't share state.
+            parent_metadata = copy.copy(redcap_data["parent_metadata"])
             if is_wsi:
                 # WSIs have additional metadata.
                 if "barcode" in halolink_image["image"]:
                     if image_barcode in redcap_data["wsi_images"]:
-                        image_metadata = redcap_data["wsi_images"][image_barcode]
+                        image_metadata = copy.copy(redcap_data["wsi_images"][image_barcode])
+                        image_metadata.parent_metadata = parent_metadata
                     else:
                         # Just use the parent metadata if the barcode can't be found.
-                        image_metadata = ImageMetadata(redcap_data["parent_metadata"])
+                        image_metadata = ImageMetadata(parent_metadata)
                         image_metadata.image_type = "WSImage"
                         image_metadata.missing_metadata = True
                         image_metadata.error_message = "WARNING: Barcode " + str(
@@ -68,12 +180,17 @@ class PipelineService:
                     image_metadata.error_message = "WARNING: Barcode is blank. "
             else:
                 # EMs and Slide Copy just use their parent metadata.
-                image_metadata = ImageMetadata(redcap_data["parent_metadata"])
+                image_metadata = ImageMetadata(parent_metadata)
 
             # Get information from the Uploader database. If it's blank, use the default.
-            uploader_info = self.uploader_connection.get_record_by_file_name(image_name)
+            if image_name in self.uploader_data_cache:
+                self.metrics.record_cache("uploader_prefetch", 1, 0)
+                uploader_info = self.uploader_data_cache[image_name]
+            else:
+                self.metrics.record_cache("uploader_prefetch", 0, 1)
+                uploader_info = await asyncio.to_thread(self.uploader_connection.get_record_by_file_name, image_name)
             if uploader_info is not None:
-                redcap_data["parent_metadata"].study_id = uploader_info["study"]
+                parent_metadata.study_id = uploader_info["study"]
                 if uploader_info["packageType"] == "Slide Copy":
                     image_metadata.image_type = "SCUImage"
                 elif uploader_info["packageType"] == "Electron Microscopy Imaging":
@@ -82,7 +199,7 @@ class PipelineService:
                 # Almost all non-WSI images are EMIMages
                 if not is_wsi:
                     image_metadata.image_type = "EMImage"
-                redcap_data["parent_metadata"].study_id = default_study
+                parent_metadata.study_id = default_study
 
             image_metadata.validate_metadata()
         else:
@@ -91,37 +208,270 @@ class PipelineService:
         self.redcap_data_cache[biopsy_id] = redcap_data
         return image_metadata
 
+    async def plan_image(self, image: dict, src_study: HLStudy, default_study_id: str) -> dict:
+        current_image_metadata = await self.get_metadata_for_image(image, default_study_id)
+        dest_study = None
+        changes = {"stain": None, "field_updates": []}
+        if current_image_metadata.in_error:
+            action = "Left in current folder."
+        else:
+            changes = self.halolink_service.get_image_changes(image["image"], current_image_metadata)
+            if current_image_metadata.missing_metadata:
+                # If the src study isn't an escrow folder, move it. Otherwise, keep it there.
+                if not src_study.value["escrow"]:
+                    dest_study = src_study.value["failure_dest"]
+                action = "Attached available metadata and moved from " + src_study.value["name"] + " to or left in " + src_study.value["failure_dest"].value["name"]
+            else:
+                dest_study = src_study.value["success_dest"]
+                action = "Attached available metadata and moved from " + src_study.value["name"] + " to " + src_study.value["success_dest"].value["name"]
+            if changes["stain"] is None and not changes["field_updates"]:
+                action = action + " Metadata was already up to date."
+        return {"image": image, "metadata": current_image_metadata, "action": action, "dest_study": dest_study,
+                "changes": changes, "errors": []}
+
+    async def apply_plans(self, plans: list, src_study: HLStudy):
+        all_plans = plans
+        # Skip anything a resumed run already finished.
+        for plan in plans:
+            completed_steps = self.completed_steps.get(plan["image"]["image"]["id"], set())
+            if "stain" in completed_steps:
+                plan["changes"]["stain"] = None
+            if "fields" in completed_steps:
+                plan["changes"]["field_updates"] = []
+            if "move" in completed_steps:
+                plan["dest_study"] = None
+
+        journal_steps = []
+        with self.metrics.time_stage("stage", stage="update_images"):
+            update_results = await self.halolink_service.update_images_metadata(
+                [(plan["image"]["image"]["id"], plan["changes"]) for plan in plans])
+        for plan, result in zip(plans, update_results):
+            plan["errors"].extend(result["errors"])
+            if result["stain"] is not None:
+                journal_steps.append((result["image_id"], "stain"))
+            if result["fields"] is not None:
+                journal_steps.append((result["image_id"], "fields"))
+
+        # Only move images whose metadata was attached.
+        plans = [plan for plan in plans if plan["dest_study"] is not None and not plan["errors"]]
+        with self.metrics.time_stage("stage", stage="move_images"):
+            move_results = await self.halolink_service.move_images(
+                [(plan["image"]["image"]["id"], src_study.value["id"], plan["dest_study"].value["id"]) for plan in plans])
+        for plan, result in zip(plans, move_results):
+            plan["errors"].extend(result["errors"])
+            if result["move"] is not None:
+                journal_steps.append((result["image_id"], "move"))
+
+        if self.run_journal is not None and journal_steps:
+            self.run_journal.record_steps(self.run_id, journal_steps)
+        if self.run_journal is not None:
+            self.run_journal.record_finished_images(
+                self.run_id, [plan["image"]["image"]["pk"] for plan in all_plans if not plan["errors"]])
+
+    async def process_batch(self, images: list, src_study: HLStudy, default_study_id: str, dry_run: bool,
+                            semaphore: asyncio.Semaphore) -> list:
+        async with semaphore:
+            with self.metrics.time_stage("stage", stage="plan_batch"):
+                plans = [await self.plan_image(image, src_study, default_study_id) for image in images]
+            if not dry_run:
+                await self.apply_plans([plan for plan in plans if not plan["metadata"].in_error], src_study)
+            self.set_error_actions(plans)
+            return plans
+
+    def set_error_actions(self, plans: list):
+        for plan in plans:
+            if plan["errors"]:
+                plan["action"] = "ERROR: " + " ".join(plan["errors"]) + " Left in current folder."
+
+    # Fetches a page's REDCap and Uploader data while other pages are still being listed or processed, then queues
+    # its batches. Returns the batch tasks in listing order.
+    async def process_page(self, images: list, src_study: HLStudy, default_study_id: str, dry_run: bool,
+                           semaphore: asyncio.Semaphore) -> list:
+        await asyncio.gather(self.prefetch_redcap_data(images), self.prefetch_uploader_data(images))
+        return [asyncio.create_task(self.process_batch(images[i:i + self.batch_size], src_study, default_study_id,
+                                                       dry_run, semaphore))
+                for i in range(0, len(images), self.batch_size)]
+
+    def get_plan_result(self, plan: dict) -> str:
+        if plan["metadata"].in_error:
+            return "left"
+        elif plan["errors"]:
+            return "failed"
+        elif plan["changes"]["stain"] is None and not plan["changes"]["field_updates"]:
+            return "unchanged"
+        return "updated"
+
+    def add_to_run_summary(self, result: str, src_study: HLStudy):
+        self.run_summary["processed"] = self.run_summary["processed"] + 1
+        self.run_summary[result] = self.run_summary[result] + 1
+        self.metrics.increment("images_total", study=src_study.value["name"], result=result)
+
+    def print_run_summary(self, incremental: bool, full_sweep: bool):
+        print(str(self.run_summary["processed"]) + " files processed.", file=self.output)
+        print(str(self.run_summary["updated"]) + " with metadata changes, " + str(self.run_summary["unchanged"])
+              + " already up to date, " + str(self.run_summary["failed"]) + " failed, " + str(self.run_summary["left"])
+              + " left with errors.", file=self.output)
+        if incremental:
+            if full_sweep:
+                print("Full sweep: every image in the folder was evaluated.", file=self.output)
+            else:
+                print(str(self.run_summary["skipped"]) + " skipped as unchanged since they were last evaluated.",
+                      file=self.output)
+        elif self.run_summary["skipped"]:
+            print(str(self.run_summary["skipped"]) + " skipped as already finished by the resumed run.",
+                  file=self.output)
+
+    # Applies a plan written by a dry run. Only the mutations are sent: no REDCap or Uploader lookups and no image
+    # downloads, just one listing of the folder to check that no planned image changed since the dry run.
+    # Returns the file names of the images that changed, and applies nothing if there are any.
+    async def apply_action_plan(self, action_plan: ActionPlan, concurrency: int = DEFAULT_APPLY_CONCURRENCY) -> list:
+        src_study = action_plan.src_study
+        self.run_summary = {"processed": 0, "updated": 0, "unchanged": 0, "failed": 0, "left": 0, "skipped": 0}
+        self.completed_steps = {}
+        self.run_id = None
+        if self.run_journal is not None and self.resume:
+            self.run_id = self.run_journal.get_unfinished_run(src_study.value["pk"])
+            if self.run_id is not None:
+                self.completed_steps = self.run_journal.get_completed_steps(self.run_id)
+        image_versions = await self.halolink_connection.get_image_versions_in_study(src_study.value["pk"])
+        # Images the interrupted run already updated or moved have changed because of the plan itself.
+        stale_images = action_plan.get_stale_images(image_versions, set(self.completed_steps))
+        if stale_images:
+            return stale_images
+        if self.run_journal is not None and self.run_id is None:
+            self.run_id = self.run_journal.start_run(src_study.value["pk"])
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def apply_batch(plans: list) -> list:
+            async with semaphore:
+                await self.apply_plans(plans, src_study)
+            return plans
+
+        plans = action_plan.get_plans()
+        tasks = [asyncio.create_task(apply_batch(plans[i:i + self.batch_size]))
+                 for i in range(0, len(plans), self.batch_size)]
+        report_sink = self.report_sink if self.report_sink is not None else TextReportSink(self.output)
+        report_sink.write_header()
+        for task in tasks:
+            batch = await task
+            self.set_error_actions(batch)
+            for plan in batch:
+                result = self.get_plan_result(plan)
+                report_sink.write({"folder": src_study.value["name"], "image_pk": plan["image"]["image"]["pk"],
+                                   "filename": plan["image"]["image"]["tag"], "metadata": plan["metadata"],
+                                   "action": plan["action"], "result": result})
+                self.add_to_run_summary(result, src_study)
+        report_sink.flush()
+        # A plan isn't listed again, so its failed images can only be finished by resuming the run.
+        if self.run_journal is not None and self.run_summary["failed"] == 0:
+            self.run_journal.finish_run(self.run_id)
+        self.print_run_summary(False, False)
+        if self.run_summary["failed"]:
+            print("Run again with --resume to finish the plan.", file=self.output)
+        return []
+
     async def get_metadata_for_images_in_study(self, src_study: HLStudy, default_study_id: str,
                                                dry_run: bool = True) -> dict:
-        images = await self.halolink_connection.get_images_in_study(src_study.value["pk"])
         image_metadata = {}
-        count = 0
-        print("Filename," + ImageMetadata(RedcapMetadata("")).get_metadata_header_string() + ",Action")
-        for image in images:
-            action = ""
-            current_image_metadata = await self.get_metadata_for_image(image, default_study_id)
-            image_metadata[image["image"]["tag"]] = current_image_metadata
-            if current_image_metadata.in_error:
-                action = "Left in current folder."
-            elif current_image_metadata.missing_metadata:
-                if not dry_run:
-                    field_update_result = await self.halolink_service.update_image_metadata(image["image"]["id"], current_image_metadata)
-
-                    # If the src study isn't an escrow folder, move it. Otherwise, keep it there.
-                    if not src_study.value["escrow"]:
-                        move_result = await self.halolink_connection.move_image(image["image"]["id"],
-                                                                                src_study.value["id"],
-                                                                                src_study.value["failure_dest"].value["id"])
-                action = "Attached available metadata and moved from " + src_study.value["name"] + " to or left in " + src_study.value["failure_dest"].value["name"]
+        start = time.perf_counter()
+        self.run_summary = {"processed": 0, "updated": 0, "unchanged": 0, "failed": 0, "left": 0, "skipped": 0}
+        self.completed_steps = {}
+        finished_images = set()
+        if not dry_run and self.run_journal is not None:
+            self.run_id = self.journal_run_id
+            if self.run_id is None:
+                self.run_id = self.run_journal.start_run(src_study.value["pk"], self.resume)
+            self.completed_steps = self.run_journal.get_completed_steps(self.run_id)
+            finished_images = self.run_journal.get_finished_images(self.run_id)
+        incremental = self.incremental and self.study_watermark is not None
+        full_sweep = True
+        image_pks = None
+        self.error_image_pks = []
+        if incremental:
+            study_image_versions = self.study_image_versions
+            self.study_image_versions = None
+            if study_image_versions is None:
+                study_image_versions = await self.halolink_connection.get_image_versions_in_study(
+                    src_study.value["pk"])
+            image_versions = study_image_versions
+            if self.image_pks is not None:
+                image_versions = {image_pk: study_image_versions[image_pk] for image_pk in self.image_pks
+                                  if image_pk in study_image_versions}
+            full_sweep = self.full_sweep or self.study_watermark.needs_full_sweep(src_study.value["pk"])
+            if full_sweep:
+                image_pks = list(image_versions)
             else:
-                if not dry_run:
-                    field_update_result = await self.halolink_service.update_image_metadata(image["image"]["id"],
-                                                                                            current_image_metadata)
-                    move_result = await self.halolink_connection.move_image(image["image"]["id"], src_study.value["id"],
-                                                                            src_study.value["success_dest"].value["id"])
-                action = "Attached available metadata and moved from " + src_study.value["name"] + " to " + src_study.value["success_dest"].value["name"]
-            print(image["image"][
-                      "tag"] + "," + current_image_metadata.get_metadata_update_string_plain() + "," + "ACTION: " + action + ",")
-            count = count + 1
-        print(str(count) + " files processed.")
+                image_pks = self.study_watermark.get_changed_images(src_study.value["pk"], image_versions)
+            self.run_summary["skipped"] = len(image_versions) - len(image_pks)
+            self.metrics.increment("images_skipped_total", self.run_summary["skipped"], study=src_study.value["name"])
+        elif self.image_pks is not None:
+            image_pks = self.image_pks
+        # Images a resumed run already finished are left out before their pages are fetched, so they cost no
+        # download, REDCap export or Uploader lookup.
+        if finished_images:
+            if image_pks is None:
+                image_pks = await self.halolink_connection.get_image_pks_in_study(src_study.value["pk"])
+            unfinished_pks = [image_pk for image_pk in image_pks if image_pk not in finished_images]
+            self.run_summary["skipped"] = self.run_summary["skipped"] + len(image_pks) - len(unfinished_pks)
+            self.metrics.increment("images_skipped_total", len(image_pks) - len(unfinished_pks),
+                                   study=src_study.value["name"])
+            image_pks = unfinished_pks
+        action_plan = self.action_plan if dry_run else None
+        if action_plan is not None and not incremental:
+            image_versions = await self.halolink_connection.get_image_versions_in_study(src_study.value["pk"])
+        report_sink = self.report_sink if self.report_sink is not None else TextReportSink(self.output)
+        report_sink.write_header()
+        # Batches are processed concurrently, but rows are printed in listing order so the report is deterministic.
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = collections.deque()
+
+        def print_batch(plans: list):
+            for plan in plans:
+                image_name = plan["image"]["image"]["tag"]
+                result = self.get_plan_result(plan)
+                report_sink.write({"folder": src_study.value["name"], "image_pk": plan["image"]["image"]["pk"],
+                                   "filename": image_name,
+                                   "metadata": plan["metadata"], "action": plan["action"], "result": result})
+                self.add_to_run_summary(result, src_study)
+                if result in ["failed", "left"]:
+                    self.error_image_pks.append(plan["image"]["image"]["pk"])
+                if action_plan is not None:
+                    action_plan.add(plan, image_versions.get(plan["image"]["image"]["pk"]))
+                if self.streaming:
+                    self.uploader_data_cache.pop(image_name, None)
+                else:
+                    image_metadata[image_name] = plan["metadata"]
+            # Failed images and images left with errors, e.g. because their biopsy isn't in REDCap yet, aren't
+            # recorded so the next run evaluates them again. Images this run changed get a new modifiedTime, so
+            # they are evaluated once more and then skipped.
+            if incremental and not dry_run:
+                self.study_watermark.record_images(
+                    src_study.value["pk"],
+                    [(plan["image"]["image"]["pk"], image_versions[plan["image"]["image"]["pk"]])
+                     for plan in plans if not plan["errors"] and not plan["metadata"].in_error])
+
+        # Later pages download while the batches of earlier pages are being processed, but no more than
+        # concurrency + 1 pages are held at once so memory stays flat however big the folder is.
+        async for images in self.halolink_connection.iter_images_in_study(src_study.value["pk"], self.page_size,
+                                                                          image_pks):
+            pending.append(asyncio.create_task(
+                self.process_page(images, src_study, default_study_id, dry_run, semaphore)))
+            while pending and pending[0].done() and all(task.done() for task in pending[0].result()):
+                for task in pending.popleft().result():
+                    print_batch(task.result())
+            while len(pending) > self.concurrency + 1:
+                for task in await pending.popleft():
+                    print_batch(await task)
+        while pending:
+            for task in await pending.popleft():
+                print_batch(await task)
+        report_sink.flush()
+        if not dry_run and self.run_journal is not None and self.journal_run_id is None:
+            self.run_journal.finish_run(self.run_id)
+        if incremental and not dry_run:
+            self.study_watermark.remove_missing_images(src_study.value["pk"], list(study_image_versions))
+            if full_sweep:
+                self.study_watermark.record_full_sweep(src_study.value["pk"])
+        self.metrics.set_gauge("study_duration_seconds", time.perf_counter() - start, study=src_study.value["name"])
+        self.print_run_summary(incremental, full_sweep)
         return image_metadata
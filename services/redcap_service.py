@@ -9,8 +9,25 @@ class RedcapService:
 
     def get_image_metadata_by_biopsy_id(self, biopsy_id: str) -> dict:
         redcap_result = self.redcap_connection.get_by_biopsy_id(biopsy_id)
+        return self.build_image_metadata(biopsy_id, redcap_result)
+
+    def get_image_metadata_by_biopsy_ids(self, biopsy_ids: list) -> dict:
+        redcap_results = self.redcap_connection.get_by_biopsy_ids(biopsy_ids)
+        return {biopsy_id: self.build_image_metadata(biopsy_id, redcap_result)
+                for biopsy_id, redcap_result in redcap_results.items()}
+
+    async def get_image_metadata_by_biopsy_id_async(self, biopsy_id: str) -> dict:
+        redcap_result = await self.redcap_connection.get_by_biopsy_id_async(biopsy_id)
+        return self.build_image_metadata(biopsy_id, redcap_result)
+
+    async def get_image_metadata_by_biopsy_ids_async(self, biopsy_ids: list) -> dict:
+        redcap_results = await self.redcap_connection.get_by_biopsy_ids_async(biopsy_ids)
+        return {biopsy_id: self.build_image_metadata(biopsy_id, redcap_result)
+                for biopsy_id, redcap_result in redcap_results.items()}
+
+    def build_image_metadata(self, biopsy_id: str, redcap_result: list):
         if redcap_result:
-            redcap_result = self.redcap_connection.get_by_biopsy_id(biopsy_id)[0]
+            redcap_result = redcap_result[0]
             redcap_metadata = RedcapMetadata(biopsy_id)
             redcap_metadata.fill_with_redcap_result(redcap_result)
             slides = {}
@@ -24,5 +41,3 @@ class RedcapService:
             return {"parent_metadata": redcap_metadata, "wsi_images": slides}
         else:
             return None
-
-
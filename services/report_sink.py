@@ -0,0 +1,129 @@
+import abc
+import csv
+import json
+import time
+
+from model.image_metadata import METADATA_HEADER, UPDATE_FIELDS
+
+# Report files are written through a large buffer and flushed every FLUSH_ROWS rows or FLUSH_INTERVAL seconds,
+# whichever comes first, so a file being tailed stays reasonably current.
+FILE_BUFFER_SIZE = 1024 * 1024
+FLUSH_ROWS = 1000
+FLUSH_INTERVAL = 5.0
+REPORT_FORMATS = ["csv", "jsonl"]
+
+FIELD_NAMES = [field.value["name"] for field, owner, name in UPDATE_FIELDS]
+CSV_HEADER = ["Folder", "Filename", "Barcode", "Stain"] + FIELD_NAMES + ["Error Message", "Action", "Result"]
+
+
+# Receives one row per image as a run finishes them. Rows are dicts with the source folder, the image PK and
+# file name, its ImageMetadata, the action taken and the result (updated, unchanged, failed or left).
+class ReportSink(abc.ABC):
+
+    def __init__(self, file):
+        self.file = file
+        self.header_written = False
+        self.rows_since_flush = 0
+        self.last_flush = time.monotonic()
+
+    def write_header(self):
+        if not self.header_written:
+            self.header_written = True
+            self.write_header_row()
+
+    def write_header_row(self):
+        pass
+
+    def write(self, row: dict):
+        self.write_row(row)
+        self.rows_since_flush = self.rows_since_flush + 1
+        if self.rows_since_flush >= FLUSH_ROWS or time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    @abc.abstractmethod
+    def write_row(self, row: dict):
+        pass
+
+    def flush(self):
+        self.file.flush()
+        self.rows_since_flush = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+# The report as the CLI has always printed it, e.g. to stdout.
+class TextReportSink(ReportSink):
+
+    def write_header_row(self):
+        print("Filename," + METADATA_HEADER + ",Action", file=self.file)
+
+    def write_row(self, row: dict):
+        print(row["filename"] + "," + row["metadata"].get_metadata_update_string_plain() + "," + "ACTION: "
+              + row["action"] + ",", file=self.file)
+
+    # Only flushed, the stream belongs to the caller.
+    def close(self):
+        self.flush()
+
+
+class CsvReportSink(ReportSink):
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.writer = csv.writer(file)
+
+    def write_header_row(self):
+        self.writer.writerow(CSV_HEADER)
+
+    def write_row(self, row: dict):
+        metadata = row["metadata"]
+        self.writer.writerow([row["folder"], row["filename"], metadata.barcode, metadata.slide_stain]
+                             + [update["value"] for update in metadata.get_halolink_updates()]
+                             + [metadata.error_message, row["action"], row["result"]])
+
+
+class JsonlReportSink(ReportSink):
+
+    def write_row(self, row: dict):
+        metadata = row["metadata"]
+        record = {"folder": row["folder"], "filename": row["filename"], "barcode": metadata.barcode,
+                  "stain": metadata.slide_stain,
+                  "fields": {update["field_enum"].value["name"]: update["value"]
+                             for update in metadata.get_halolink_updates()},
+                  "error_message": metadata.error_message, "action": row["action"], "result": row["result"]}
+        self.file.write(json.dumps(record) + "\n")
+
+
+# Sends a shard's rows to the work queue of a sharded run. The parent process merges them in listing order.
+class WorkQueueReportSink(ReportSink):
+
+    def __init__(self, work_queue, run_id: int, shard: int, positions: dict):
+        super().__init__(None)
+        self.work_queue = work_queue
+        self.run_id = run_id
+        self.shard = shard
+        self.positions = positions
+        self.rows = []
+
+    def write_row(self, row: dict):
+        self.rows.append((self.positions[row["image_pk"]], row["folder"], row["filename"], row["action"],
+                          row["result"], row["metadata"]))
+
+    def flush(self):
+        if self.rows:
+            self.work_queue.add_rows(self.run_id, self.shard, self.rows)
+            self.rows = []
+        self.rows_since_flush = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+
+def open_report_sink(path: str, report_format: str = "csv") -> ReportSink:
+    if report_format == "jsonl":
+        return JsonlReportSink(open(path, "w", buffering=FILE_BUFFER_SIZE))
+    return CsvReportSink(open(path, "w", newline="", buffering=FILE_BUFFER_SIZE))